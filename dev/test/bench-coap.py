@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# License: Apache v2
+# Measures how many CoAP messages per second COAPMessage encodes and decodes
+# for typical GPIO requests and responses, no network is needed.
+#   usage: bench-coap.py [iterations]
+
+import os
+import sys
+import json
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../webiopi_0.7.1/python"))
+
+from webiopi.protocols.coap import COAPMessage, COAPRequest, COAPResponse, COAPOption
+
+def request(code, path, accept=None):
+    message = COAPRequest(COAPMessage.CON, code, "coap://localhost%s" % path)
+    message.id = 0x1234
+    message.token = bytearray(b"\x01\x02\x03\x04")
+    if accept != None:
+        message.addOption(COAPOption.ACCEPT, accept)
+    return message
+
+def response(payload, contentFormat, *options):
+    message = COAPResponse()
+    message.type = COAPMessage.ACK
+    message.code = COAPResponse.CONTENT
+    message.id = 0x1234
+    message.token = bytearray(b"\x01\x02\x03\x04")
+    message.content_format = contentFormat
+    message.payload = payload
+    for (number, value) in options:
+        message.addOption(number, value)
+    return message
+
+STATE = json.dumps({"GPIO": dict(("%d" % gpio, {"function": "IN", "value": gpio % 2}) for gpio in range(2, 28))})
+
+MESSAGES = [
+    ("GET /GPIO/17/value", request(COAPRequest.GET, "/GPIO/17/value")),
+    ("POST /GPIO/17/value/1", request(COAPRequest.POST, "/GPIO/17/value/1")),
+    ("GET /GPIO/17/function", request(COAPRequest.GET, "/GPIO/17/function", 50)),
+    ("GET /* observe", request(COAPRequest.GET, "/*", 50)),
+    ("2.05 value", response("1", 0)),
+    ("2.05 state block", response(STATE[:512], 50, (COAPOption.ETAG, bytearray(b"\x12\x34\x56\x78")),
+                                  (COAPOption.OBSERVE, 12), (COAPOption.MAX_AGE, 60),
+                                  (COAPOption.BLOCK2, 0x0D), (COAPOption.SIZE2, len(STATE)))),
+]
+MESSAGES[3][1].addOption(COAPOption.OBSERVE, 0)
+
+def decode(cls, data):
+    message = cls()
+    message.parseByteArray(data)
+    return message
+
+def main():
+    iterations = 50000
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+
+    for (name, message) in MESSAGES:
+        cls = message.__class__
+        data = bytearray(message.getBytes())
+        parsed = decode(cls, data)
+        assert parsed.uri_path == message.uri_path and parsed.getPayloadBytes() == message.getPayloadBytes(), name
+
+        encode = timeit.timeit(message.getBytes, number=iterations)
+        parse = timeit.timeit(lambda: decode(cls, data), number=iterations)
+        print("  %-24s %5d bytes   encode %8.0f msg/s   decode %8.0f msg/s" % (name, len(data),
+              iterations / encode, iterations / parse))
+
+if __name__ == "__main__":
+    main()
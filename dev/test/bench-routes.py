@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# License: Apache v2
+# Compares device route lookups through the compiled route trie with the
+# former linear scan matching each path with extract, no hardware is needed.
+#   usage: bench-routes.py [iterations]
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../webiopi_0.7.1/python"))
+
+from webiopi.utils import types
+from webiopi.utils.routes import RouteTrie
+from webiopi.devices.digital.gpio import NativeGPIO
+from webiopi.devices.memory import Memory
+
+REQUESTS = {
+    NativeGPIO: [("GET", "17/value"), ("GET", "17/function"), ("GET", "18/hwpwm/duty"),
+                 ("POST", "17/value/1"), ("POST", "18/pulseRatio/0.5"), ("POST", "18/hwpwm/duty/512")],
+    Memory:     [("GET", "memory/byte/4"), ("GET", "memory/bytes/0,16"),
+                 ("POST", "memory/byte/4/255"), ("POST", "memory/long/8/0xFFFF")],
+}
+
+def collectRoutes(cls):
+    funcs = {"GET": {}, "POST": {}}
+    routes = {"GET": RouteTrie(), "POST": RouteTrie()}
+    for att in dir(cls):
+        func = getattr(cls, att)
+        if callable(func) and hasattr(func, "routed"):
+            funcs[func.method][func.path] = func
+            routes[func.method].add(func.path, func)
+    return (funcs, routes)
+
+# the former RESTHandler.extract, kept as the baseline
+def extract(fmtArray, pathArray, args):
+    if len(fmtArray) != len(pathArray):
+        return False
+    if len(fmtArray) == 0:
+        return True
+    fmt = fmtArray[0]
+    path = pathArray[0]
+    if fmt == path:
+        return extract(fmtArray[1:], pathArray[1:], args)
+    if fmt.startswith("%"):
+        fmt = fmt[1:]
+        t = 's'
+        if fmt[0] == '(':
+            if fmt[-1] == ')':
+                name = fmt[1:-1]
+            elif fmt[-2] == ')':
+                name = fmt[1:-2]
+                t = fmt[-1]
+            else:
+                raise Exception("Missing closing brace")
+        else:
+            name = fmt
+
+        if t == 's':
+            args[name] = path
+        elif t == 'b':
+            args[name] = types.str2bool(path)
+        elif t == 'd':
+            args[name] = types.toint(path)
+        elif t == 'x':
+            args[name] = int(path, 16)
+        elif t == 'f':
+            args[name] = float(path)
+        else:
+            raise Exception("Unknown format type : %s" % t)
+
+        return extract(fmtArray[1:], pathArray[1:], args)
+
+    return False
+
+def linearLookup(funcs, path):
+    if path in funcs:
+        return (funcs[path], {})
+    pathArray = path.split("/")
+    for fname in funcs:
+        func = funcs[fname]
+        args = {}
+        if extract(func.path.split("/"), pathArray, args):
+            return (func, args)
+    return (None, None)
+
+def trieLookup(funcs, trie, path):
+    if path in funcs:
+        return (funcs[path], {})
+    return trie.find(path)
+
+def main():
+    iterations = 20000
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+
+    for cls in REQUESTS:
+        (funcs, routes) = collectRoutes(cls)
+        print("%s : %d routes" % (cls.__name__, len(funcs["GET"]) + len(funcs["POST"])))
+        for (method, path) in REQUESTS[cls]:
+            (linearFunc, linearArgs) = linearLookup(funcs[method], path)
+            (trieFunc, trieArgs) = trieLookup(funcs[method], routes[method], path)
+            assert linearFunc == trieFunc and linearArgs == trieArgs, path
+
+            linear = timeit.timeit(lambda: linearLookup(funcs[method], path), number=iterations)
+            trie = timeit.timeit(lambda: trieLookup(funcs[method], routes[method], path), number=iterations)
+            print("  %-4s %-24s linear %6.2f us   trie %6.2f us   x%.1f" % (method, path,
+                  linear * 1000000 / iterations, trie * 1000000 / iterations, linear / trie))
+
+if __name__ == "__main__":
+    main()
@@ -71,6 +71,7 @@ if (deviceAgent.match(/(iphone|ipod|ipad)/) ||
 function WebIOPi() {
 	this.readyCallback = null;
 	this.context = "/";
+	this.stateVersion = 0;
 	this.GPIO = Array(54);
 	this.PINS = Array(41);
 
@@ -264,13 +265,15 @@ WebIOPi.prototype.updateALT = function (alt, enable) {
 	alt.enabled = enable;
 }
 
-WebIOPi.prototype.refreshGPIO = function (repeat) {
-	$.getJSON(w().context + "*", function(data) {
-		w().updateALT(w().ALT.I2C, data["I2C"]);
-		w().updateALT(w().ALT.SPI, data["SPI"]);
-		w().updateALT(w().ALT.UART, data["UART"]);
-		w().updateALT(w().ALT.ONEWIRE, data["ONEWIRE"]);
-		
+WebIOPi.prototype.updateState = function (data) {
+	// event streams only carry what changed since the last update
+	$.each(["I2C", "SPI", "UART", "ONEWIRE"], function(i, bus) {
+		if (data[bus] != undefined) {
+			w().updateALT(w().ALT[bus], data[bus]);
+		}
+	});
+	
+	if (data["GPIO"] != undefined) {
 		$.each(data["GPIO"], function(gpio, data) {
 	    	w().updateFunction(gpio, data["function"]);
 	    	if ( ((gpio != 4) && ((data["function"] == "IN") || (data["function"] == "OUT"))
@@ -283,12 +286,54 @@ WebIOPi.prototype.refreshGPIO = function (repeat) {
 	    	}
 	    	
 		});
-	});
-	if (repeat === true) {
-		setTimeout(function(){w().refreshGPIO(repeat)}, 1000);
 	}
 }
 
+WebIOPi.prototype.refreshGPIO = function (repeat) {
+	if ((repeat === true) && (w().events == undefined) && (window.EventSource != undefined)) {
+		w().events = new EventSource(w().context + "events");
+		w().events.addEventListener("state", function(event) {
+			w().updateState(JSON.parse(event.data));
+		});
+		w().events.onerror = function() {
+			// the server refused the stream, fallback to polling
+			if (w().events.readyState == EventSource.CLOSED) {
+				w().events = false;
+				w().refreshGPIO(repeat);
+			}
+		};
+		return;
+	}
+	if ((repeat === true) && w().events) {
+		return;
+	}
+	
+	if (repeat !== true) {
+		$.getJSON(w().context + "*", function(data) {
+			w().updateState(data);
+		});
+		return;
+	}
+	
+	// long-polling, the server answers when something changed since stateVersion
+	var start = new Date().getTime();
+	$.ajax({
+		url: w().context + "*?since=" + w().stateVersion + "&wait=30",
+		dataType: "json",
+		success: function(data, status, xhr) {
+			var version = xhr.getResponseHeader("X-State-Version");
+			if (version != null) {
+				w().stateVersion = version;
+			}
+			w().updateState(data);
+		},
+		complete: function() {
+			var elapsed = new Date().getTime() - start;
+			setTimeout(function(){w().refreshGPIO(repeat)}, Math.max(0, 1000 - elapsed));
+		}
+	});
+}
+
 
 WebIOPi.prototype.checkVersion = function () {
 	var version;
@@ -386,6 +431,15 @@ WebIOPi.prototype.callMacro = function (macro, args, callback) {
 	});
 }
 
+WebIOPi.prototype.batch = function (operations, callback) {
+	// operations : [{method: "POST", path: "GPIO/17/value/1"}, ...]
+	$.post(w().context + 'batch', JSON.stringify(operations), function(data) {
+		if (callback != undefined) {
+			callback(operations, data);
+		}
+	}, "json");
+}
+
 WebIOPi.prototype.enablePWM = function(gpio, callback) {
 	$.post(w().context + 'GPIO/' + gpio + "/pwm/enable", function(data) {
 		if (callback != undefined) {
@@ -1,3 +1,5 @@
+from webiopi.utils.types import parseDuration
+
 def request(method="GET", path="", data=None):
     def wrapper(func):
         func.routed = True
@@ -7,13 +9,33 @@ def request(method="GET", path="", data=None):
         return func
     return wrapper
 
-def response(fmt="%s", contentType="text/plain"):
+def response(fmt="%s", contentType="text/plain", immutable=False, maxAge=0):
+    # immutable results are computed once per device and kept by clients for an hour,
+    # maxAge lets clients and the server reuse results for that many seconds
     def wrapper(func):
         func.format = fmt
         func.contentType = contentType
+        func.immutable = immutable
+        func.maxAge = parseDuration(maxAge)
+        return func
+    return wrapper
+
+def cached(ttl):
+    # GET responses are reused for ttl seconds, or a string like "500ms"
+    def wrapper(func):
+        func.cacheTTL = parseDuration(ttl)
         return func
     return wrapper
 
-def macro(func):
-    func.macro = True
-    return func
+def macro(func=None, asynchronous=False, timeout=0, workers=1):
+    # @macro, or @macro(asynchronous=True) to answer 202 with a job id at once,
+    # the job runs on its own pool of workers and expires after timeout
+    def wrapper(func):
+        func.macro = True
+        func.asynchronous = asynchronous
+        func.timeout = parseDuration(timeout)
+        func.workers = workers
+        return func
+    if func != None:
+        return wrapper(func)
+    return wrapper
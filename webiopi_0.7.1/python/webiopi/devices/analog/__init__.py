@@ -34,22 +34,22 @@ class ADC():
             raise ValueError("Value %d out of range [%d..%d]" % (value, 0, self._analogMax))
     
     @request("GET", "analog/count")
-    @response("%d")
+    @response("%d", immutable=True)
     def analogCount(self):
         return self._analogCount
 
     @request("GET", "analog/resolution")
-    @response("%d")
+    @response("%d", immutable=True)
     def analogResolution(self):
         return self._analogResolution
     
     @request("GET", "analog/max")
-    @response("%d")
+    @response("%d", immutable=True)
     def analogMaximum(self):
         return int(self._analogMax)
     
     @request("GET", "analog/vref")
-    @response("%.2f")
+    @response("%.2f", immutable=True)
     def analogReference(self):
         return self._analogRef
     
@@ -162,17 +162,17 @@ class PWM():
         raise NotImplementedError
     
     @request("GET", "pwm/count")
-    @response("%d")
+    @response("%d", immutable=True)
     def pwmCount(self):
         return self._pwmCount
 
     @request("GET", "pwm/resolution")
-    @response("%d")
+    @response("%d", immutable=True)
     def pwmResolution(self):
         return self._pwmResolution
     
     @request("GET", "pwm/max")
-    @response("%d")
+    @response("%d", immutable=True)
     def pwmMaximum(self):
         return int(self._pwmMax)
     
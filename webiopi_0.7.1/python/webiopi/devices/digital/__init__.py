@@ -41,12 +41,12 @@ class GPIOPort():
             raise ValueError("Banks %d out of range [%d..%d]" % (banks, 0, self.digitalChannelCount))
     
     @request("GET", "count")
-    @response("%d")
+    @response("%d", immutable=True)
     def digitalCount(self):
         return self.digitalChannelCount
 
     @request("GET", "banks")
-    @response("%d")
+    @response("%d", immutable=True)
     def bankCount(self):
         return self.digitalBanksCount
 
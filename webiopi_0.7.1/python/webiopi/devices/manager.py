@@ -1,11 +1,21 @@
 import imp
+import os
+import binascii
 from webiopi.utils import logger
-from webiopi.utils import types
+from webiopi.utils.routes import RouteTrie
+from webiopi.utils.cache import LRUCache
 from webiopi.devices.instance import DEVICES
 
 from webiopi.devices import serial, digital, analog, sensor, shield, clock, memory
 
 PACKAGES = [serial, digital, analog, sensor, shield, clock, memory]
+
+# listings are built once from DEVICES, adding or closing devices clears them
+LISTINGS = {}
+listingsVersion = 0
+# tells versions apart from the ones of a previous run
+listingsEpoch = binascii.hexlify(os.urandom(4)).decode()
+
 def findDeviceClass(name):
     for package in PACKAGES:
         if hasattr(package, name):
@@ -18,7 +28,7 @@ def findDeviceClass(name):
                     return getattr(module, name)
     return None
 
-def addDevice(name, device, args):
+def addDevice(name, device, args, cacheTTL=0):
     devClass = findDeviceClass(device)
     if devClass == None:
         raise Exception("Device driver not found for %s" % device)
@@ -26,10 +36,11 @@ def addDevice(name, device, args):
         dev = devClass(**args)
     else:
         dev = devClass()
-    addDeviceInstance(name, dev, args)
+    addDeviceInstance(name, dev, args, cacheTTL)
 
-def addDeviceInstance(name, dev, args):
+def addDeviceInstance(name, dev, args, cacheTTL=0):
     funcs = {"GET": {}, "POST": {}}
+    routes = {"GET": RouteTrie(), "POST": RouteTrie()}
     for att in dir(dev):
         func = getattr(dev, att)
         if callable(func) and hasattr(func, "routed"):
@@ -38,8 +49,10 @@ def addDeviceInstance(name, dev, args):
             else:
                 logger.debug("Mapping %s.%s to REST %s /devices/%s/%s" % (dev, att, func.method, name, func.path))
             funcs[func.method][func.path] = func
+            routes[func.method].add(func.path, func)
     
-    DEVICES[name] = {'device': dev, 'functions': funcs}
+    DEVICES[name] = {'device': dev, 'functions': funcs, 'routes': routes, 'cache': LRUCache(64), 'cacheTTL': cacheTTL, 'values': LRUCache(64), 'generation': 0}
+    clearListings()
     if name == "GPIO":
         logger.info("GPIO - Native mapped to REST API /GPIO")
     else:
@@ -51,9 +64,31 @@ def closeDevices():
         device = DEVICES[name]["device"]
         logger.debug("Closing device %s - %s" %  (name, device))
         del DEVICES[name]
+        clearListings()
         device.close()
 
-def getDevicesJSON(compact=False):
+def clearListings():
+    global listingsVersion
+    LISTINGS.clear()
+    listingsVersion += 1
+
+def getListingsVersion():
+    return "%s.%d" % (listingsEpoch, listingsVersion)
+
+def getListing(key, build):
+    listing = LISTINGS.get(key)
+    if listing == None:
+        version = listingsVersion
+        listing = build()
+        # a listing built while devices changed is not kept
+        if version == listingsVersion:
+            LISTINGS[key] = listing
+    return listing
+
+def getDevices():
+    return getListing(("devices",), buildDevices)
+
+def buildDevices():
     devname = "name"
     devtype = "type"
     
@@ -71,7 +106,21 @@ def getDevicesJSON(compact=False):
                     devices.append({devname: devName, devtype:fam})
                     
         else:
-            devices.append({devname: devName, type:instance.__str__()})
+            devices.append({devname: devName, devtype:instance.__str__()})
+
+    return sorted(devices, key=lambda dev: dev[devname])
 
-    return types.jsonDumps(sorted(devices, key=lambda dev: dev[devname]))
+def getRoutes():
+    # method, path template and content type of the functions of each device
+    return getListing(("routes",), buildRoutes)
+
+def buildRoutes():
+    index = {}
+    for devName in DEVICES:
+        routes = []
+        for method in DEVICES[devName]["functions"]:
+            for (path, func) in DEVICES[devName]["functions"][method].items():
+                routes.append({"method": method, "path": path, "type": getattr(func, "contentType", None)})
+        index[devName] = sorted(routes, key=lambda route: (route["path"], route["method"]))
+    return index
 
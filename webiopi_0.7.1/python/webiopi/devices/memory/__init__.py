@@ -143,22 +143,22 @@ class Memory():
         # }
 
     @request("GET", "memory/bit/count")
-    @response("%d")
+    @response("%d", immutable=True)
     def bitCount(self):
         return self._byteCount * 8
 
     @request("GET", "memory/byte/count")
-    @response("%d")
+    @response("%d", immutable=True)
     def byteCount(self):
         return self._byteCount
 
     @request("GET", "memory/word/count")
-    @response("%d")
+    @response("%d", immutable=True)
     def wordCount(self):
         return self._byteCount >> 1
 
     @request("GET", "memory/long/count")
-    @response("%d")
+    @response("%d", immutable=True)
     def longCount(self):
         return self._byteCount >> 2
         
@@ -0,0 +1,322 @@
+#   Copyright 2012-2013 Eric Ptak - trouch.com
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# asyncio engine, Python 3 only : sockets are served from a single event loop
+# and requests are handed to the existing HTTP and CoAP handlers in an executor
+
+import io
+import os
+import struct
+import asyncio
+import threading
+import concurrent.futures
+from http.server import BaseHTTPRequestHandler
+
+from webiopi.utils.logger import info, exception
+from webiopi.protocols.http import HTTPHandler, formatEvent, EVENTS_PING_INTERVAL
+from webiopi.protocols import websocket
+from webiopi.protocols.coap import COAPEndpoint, createServerSocket, joinMulticastGroup
+
+class HTTPRequestBuffer():
+    # stands for the client socket while HTTPHandler runs in the executor
+    def __init__(self, data, requestCount, polled=False):
+        self.data = data
+        self.requestCount = requestCount
+        self.polled = polled
+        self.output = []
+        self.stream = None
+        self.poll = None
+        self.websocket = False
+
+    def makefile(self, mode, bufsize=-1):
+        return io.BytesIO(self.data)
+
+    def settimeout(self, timeout):
+        pass
+
+    def sendall(self, data):
+        self.output.append(bytes(data))
+
+    def sendfile(self, f, offset, count):
+        # keep the file open to let the event loop send it without copy
+        self.output.append((os.fdopen(os.dup(f.fileno()), 'rb'), offset, count))
+
+class AsyncHTTPHandler(HTTPHandler):
+    def setup(self):
+        # the request is read by the event loop, from memory here
+        BaseHTTPRequestHandler.setup(self)
+        self.requestCount = self.request.requestCount
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+
+    def streamEvents(self, monitor, paths):
+        # the event loop streams the events itself instead of holding a worker
+        self.request.stream = (monitor, paths)
+
+    def runWebSocket(self):
+        self.request.websocket = True
+
+    def getVersioned(self, relativePath, since, wait, compact):
+        # the event loop waits for the change instead of a worker, then the
+        # request is handled again
+        handler = self.server.handler
+        result = handler.getVersioned(relativePath, since, 0, compact)
+        if wait <= 0 or self.request.polled or handler.monitor == None:
+            return result
+        if handler.getHeaders().get("X-State-Version") != since:
+            # changed, or cannot be versioned
+            return result
+        self.request.poll = (handler.monitor, relativePath, handler.monitor.parseVersion(since), wait, compact)
+        return None
+
+class AsyncCOAPEndpoint(COAPEndpoint):
+    def __init__(self, server, handler, **options):
+        COAPEndpoint.__init__(self, handler, **options)
+        self.server = server
+        self.transport = None
+
+    def sendDatagram(self, data, client):
+        # notifications are sent from other threads than the event loop one
+        try:
+            self.server.loop.call_soon_threadsafe(self.transport.sendto, bytes(data), client)
+        except RuntimeError:
+            pass
+
+class COAPDatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server.coap.transport = transport
+
+    def datagram_received(self, data, client):
+        future = self.server.loop.run_in_executor(self.server.executor, self.server.coap.processDatagram, data, client)
+        future.add_done_callback(lambda f: self.sendResponse(f, client))
+
+    def sendResponse(self, future, client):
+        try:
+            responseBytes = future.result()
+            if responseBytes != None:
+                self.transport.sendto(bytes(responseBytes), client)
+        except Exception as e:
+            exception(e)
+
+class AsyncServer(threading.Thread):
+    def __init__(self, host, httpContext, coapPort, handler, workers=4, coapOptions={}):
+        threading.Thread.__init__(self, name="AsyncioThread")
+        self.host = host
+        self.http = httpContext
+        self.coapPort = coapPort
+        self.coapSocket = None
+        self.httpServer = None
+        if coapPort > 0:
+            self.coap = AsyncCOAPEndpoint(self, handler, **coapOptions)
+            self.coapSocket = createServerSocket(coapPort)
+            self.coapSocket.setblocking(False)
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self.loop = asyncio.new_event_loop()
+        self.ready = threading.Event()
+        self.running = True
+        self.start()
+        self.ready.wait()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.startServers())
+        except Exception as e:
+            exception(e)
+            self.running = False
+        self.ready.set()
+        if self.running:
+            info("Asyncio engine using %d workers" % self.executor._max_workers)
+            self.loop.run_forever()
+        self.loop.run_until_complete(self.stopServers())
+        self.loop.close()
+        info("Asyncio engine stopped")
+
+    async def startServers(self):
+        if self.http != None:
+            self.httpServer = await asyncio.start_server(self.handleHTTP, port=self.http.port)
+            info("HTTP Server binded on http://%s:%s%s" % (self.host, self.http.port, self.http.context))
+        if self.coapSocket != None:
+            await self.loop.create_datagram_endpoint(lambda: COAPDatagramProtocol(self), sock=self.coapSocket)
+            info("CoAP Server binded on coap://%s:%s/" % (self.host, self.coapPort))
+
+    async def stopServers(self):
+        if self.httpServer != None:
+            self.httpServer.close()
+        tasks = [task for task in asyncio.all_tasks(self.loop) if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def enableMulticast(self, multicast_ip='224.0.1.123'):
+        if self.coapSocket != None:
+            joinMulticastGroup(self.coapSocket, multicast_ip)
+            info("CoAP Server binded on coap://%s:%s/ (MULTICAST)" % (multicast_ip, self.coapPort))
+
+    def runHTTPHandler(self, data, client, requestCount, polled=False):
+        request = HTTPRequestBuffer(data, requestCount, polled)
+        handler = AsyncHTTPHandler(request, client, self.http)
+        return (request, handler.close_connection)
+
+    async def readHTTPRequest(self, reader, timeout):
+        deadline = self.loop.time() + timeout
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout)
+        length = 0
+        for line in head.split(b"\r\n"):
+            (name, sep, value) = line.partition(b":")
+            if name.strip().lower() == b"content-length":
+                length = int(value.strip())
+        if length > 0:
+            head += await asyncio.wait_for(reader.readexactly(length), max(deadline - self.loop.time(), 0))
+        return head
+
+    async def handleHTTP(self, reader, writer):
+        client = writer.get_extra_info("peername")
+        requestCount = 0
+        try:
+            while True:
+                if requestCount == 0:
+                    timeout = self.http.timeout
+                else:
+                    timeout = self.http.keepAliveTimeout
+                data = await self.readHTTPRequest(reader, timeout)
+                (request, close) = await self.loop.run_in_executor(self.executor, self.runHTTPHandler, data, client, requestCount)
+                if request.poll != None:
+                    await self.waitChanges(*request.poll)
+                    (request, close) = await self.loop.run_in_executor(self.executor, self.runHTTPHandler, data, client, requestCount, True)
+                await self.writeHTTPResponse(writer, request.output)
+                if request.stream != None:
+                    await self.streamEvents(writer, *request.stream)
+                elif request.websocket:
+                    await self.runWebSocket(reader, writer)
+                requestCount += 1
+                if close:
+                    break
+        except (asyncio.CancelledError, asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError, ConnectionError):
+            pass
+        except Exception as e:
+            exception(e)
+        finally:
+            writer.close()
+
+    def publishEvent(self, events, event, data):
+        try:
+            self.loop.call_soon_threadsafe(events.put_nowait, (event, data))
+        except RuntimeError:
+            pass
+
+    def setEvent(self, event):
+        try:
+            self.loop.call_soon_threadsafe(event.set)
+        except RuntimeError:
+            pass
+
+    async def waitChanges(self, monitor, path, since, wait, compact):
+        changed = asyncio.Event()
+        waiter = monitor.addWaiter(path, since, lambda: self.setEvent(changed), compact)
+        try:
+            await asyncio.wait_for(changed.wait(), wait)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            monitor.removeWaiter(waiter)
+
+    async def streamEvents(self, writer, monitor, paths):
+        events = asyncio.Queue()
+        subscription = monitor.subscribe(lambda event, data: self.publishEvent(events, event, data), paths)
+        try:
+            while True:
+                try:
+                    (event, data) = await asyncio.wait_for(events.get(), EVENTS_PING_INTERVAL)
+                    writer.write(formatEvent(event, data))
+                except asyncio.TimeoutError:
+                    writer.write(b": ping\n\n")
+                await asyncio.wait_for(writer.drain(), self.http.timeout)
+        finally:
+            monitor.unsubscribe(subscription)
+
+    def sendFrame(self, writer, opcode, payload):
+        try:
+            self.loop.call_soon_threadsafe(writer.write, websocket.encodeFrame(opcode, payload))
+        except RuntimeError:
+            pass
+
+    async def readFrame(self, reader):
+        head = await reader.readexactly(2)
+        (fin, opcode, masked, length) = websocket.parseHeader(head)
+        if length == 126:
+            length = struct.unpack("!H", await reader.readexactly(2))[0]
+        elif length == 127:
+            length = struct.unpack("!Q", await reader.readexactly(8))[0]
+        if length > websocket.WEBSOCKET_MAX_SIZE:
+            raise ValueError("WebSocket frame too big")
+        mask = None
+        if masked:
+            mask = await reader.readexactly(4)
+        payload = await reader.readexactly(length)
+        if mask != None:
+            payload = websocket.unmask(mask, payload)
+        return (fin, opcode, payload)
+
+    async def runWebSocket(self, reader, writer):
+        session = websocket.WebSocketSession(self.http.handler, lambda text: self.sendFrame(writer, websocket.OP_TEXT, text.encode()))
+        try:
+            while True:
+                (fin, opcode, payload) = await self.readFrame(reader)
+                if opcode == websocket.OP_PING:
+                    writer.write(websocket.encodeFrame(websocket.OP_PONG, payload))
+                    continue
+                messages = session.processFrame(fin, opcode, payload)
+                if messages == None:
+                    writer.write(websocket.encodeFrame(websocket.OP_CLOSE, payload[:2]))
+                    await writer.drain()
+                    break
+                for message in messages:
+                    reply = await self.loop.run_in_executor(self.executor, session.processMessage, message)
+                    writer.write(websocket.encodeFrame(websocket.OP_TEXT, reply.encode()))
+                await asyncio.wait_for(writer.drain(), self.http.timeout)
+        finally:
+            session.close()
+
+    async def writeHTTPResponse(self, writer, output):
+        for item in output:
+            if isinstance(item, bytes):
+                writer.write(item)
+                continue
+            (f, offset, count) = item
+            try:
+                await writer.drain()
+                await self.loop.sendfile(writer.transport, f, offset, count)
+            finally:
+                f.close()
+        await writer.drain()
+
+    def stop(self):
+        self.running = False
+        if self.http != None:
+            self.http.running = False
+        if self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        self.join()
+        if self.coapSocket != None:
+            self.coap.stop()
+            self.coapSocket.close()
+        self.executor.shutdown(False)
@@ -14,7 +14,14 @@
 
 from webiopi.utils.version import PYTHON_MAJOR
 from webiopi.utils.logger import info, exception 
+from webiopi.utils.types import SERIALIZERS
+from webiopi.utils.cache import LRUCache, clock
+from webiopi.utils.thread import WorkerPool
 
+import os
+import json
+import zlib
+import heapq
 import socket
 import struct
 import logging
@@ -23,6 +30,33 @@ import threading
 M_PLAIN = "text/plain"
 M_JSON  = "application/json"
 
+# seconds between notifications of an observed resource that did not change
+OBSERVE_MAX_AGE = 60
+
+# confirmable notifications retransmission (RFC 7252)
+ACK_TIMEOUT = 2
+MAX_RETRANSMIT = 4
+
+# payloads bigger than a block are split with Block1/Block2 options (RFC 7959),
+# a power of two between 16 and 1024
+COAP_BLOCK_SIZE = 512
+
+# seconds a serialized response or a partial request body is kept between blocks
+BLOCK_CACHE_TTL = 30
+
+# biggest request body assembled from Block1 transfers
+BLOCK_MAX_BODY = 65536
+
+# seconds before a confirmable request still being processed is acknowledged
+# with an empty ACK, its response is then sent apart
+COAP_ACK_DELAY = 0.5
+
+# seconds a response is kept to answer retransmissions of its request (RFC 7252)
+EXCHANGE_LIFETIME = 247
+
+# responses kept for retransmissions
+EXCHANGE_CACHE_SIZE = 1024
+
 if PYTHON_MAJOR >= 3:
     from urllib.parse import urlparse
 else:
@@ -36,6 +70,22 @@ except:
 def HTTPCode2CoAPCode(code):
     return int(code/100) * 32 + (code%100)
 
+def getBlockSZX(size):
+    szx = 0
+    while 2 ** (szx + 4) < size and szx < 6:
+        szx += 1
+    return szx
+
+def encodeBlock(num, more, szx):
+    value = (num << 4) | szx
+    if more:
+        value |= 0x08
+    return value
+
+def decodeBlock(value):
+    # (num, more, szx), the block size is 2 ** (szx + 4)
+    return (value >> 4, (value & 0x08) != 0, min(value & 0x07, 6))
+
    
 class COAPContentFormat():
     FORMATS = {0: "text/plain",
@@ -43,7 +93,8 @@ class COAPContentFormat():
                41: "application/xml",
                42: "application/octet-stream",
                47: "application/exi",
-               50: "application/json"
+               50: "application/json",
+               60: "application/cbor"
                }
 
     @staticmethod
@@ -71,35 +122,110 @@ class COAPOption():
                3: "Uri-Host",
                4: "ETag",
                5: "If-None-Match",
+               6: "Observe",
                7: "Uri-Port",
                8: "Location-Path",
                11: "Uri-Path",
                12: "Content-Format",
                14: "Max-Age",
                15: "Uri-Query",
-               16: "Accept",
+               17: "Accept",
                20: "Location-Query",
+               23: "Block2",
+               27: "Block1",
+               28: "Size2",
                35: "Proxy-Uri",
-               39: "Proxy-Scheme"
+               39: "Proxy-Scheme",
+               60: "Size1"
                }
     
     IF_MATCH = 1
     URI_HOST = 3
     ETAG = 4
     IF_NONE_MATCH = 5
+    OBSERVE = 6
     URI_PORT = 7
     LOCATION_PATH = 8
     URI_PATH = 11
     CONTENT_FORMAT = 12
     MAX_AGE = 14
     URI_QUERY = 15
-    ACCEPT = 16
+    ACCEPT = 17
     LOCATION_QUERY = 20
+    BLOCK2 = 23
+    BLOCK1 = 27
+    SIZE2 = 28
     PROXY_URI = 35
     PROXY_SCHEME = 39
+    SIZE1 = 60
+    REQUEST_TAG = 292
     
     
-class COAPMessage():
+# options holding an unsigned integer or opaque bytes, the others are strings
+INTEGER_OPTIONS = frozenset([COAPOption.OBSERVE, COAPOption.URI_PORT, COAPOption.CONTENT_FORMAT, COAPOption.MAX_AGE,
+                             COAPOption.ACCEPT, COAPOption.BLOCK2, COAPOption.BLOCK1, COAPOption.SIZE2, COAPOption.SIZE1])
+OPAQUE_OPTIONS = frozenset([COAPOption.IF_MATCH, COAPOption.ETAG, COAPOption.REQUEST_TAG])
+
+HEADER = struct.Struct("!BBH")
+
+# option headers with a delta and a length both below 13 fit in one byte
+OPTION_HEADERS = [struct.pack("!B", (delta << 4) | length) for delta in range(13) for length in range(13)]
+
+def encodeOptionHeader(delta, length):
+    if delta < 13 and length < 13:
+        return OPTION_HEADERS[delta * 13 + length]
+    header = bytearray(1)
+    nibbles = 0
+    for value in (delta, length):
+        nibbles <<= 4
+        if value > 268:
+            nibbles |= 14
+            header.extend(struct.pack("!H", value - 269))
+        elif value > 12:
+            nibbles |= 13
+            header.append(value - 13)
+        else:
+            nibbles |= value
+    header[0] = nibbles
+    return bytes(header)
+
+def encodeUint(value):
+    if value <= 0:
+        return b""
+    elif value < 0x100:
+        return struct.pack("!B", value)
+    elif value < 0x10000:
+        return struct.pack("!H", value)
+    elif value < 0x1000000:
+        return struct.pack("!I", value)[1:]
+    return struct.pack("!I", value)
+
+if PYTHON_MAJOR >= 3:
+    def decodeUint(data):
+        return int.from_bytes(data, "big")
+
+    def decodeString(data):
+        return str(data, "UTF-8")
+
+    def encodeString(value):
+        return value.encode()
+else:
+    def decodeUint(data):
+        value = 0
+        for b in bytearray(data):
+            value = (value << 8) | b
+        return value
+
+    def decodeString(data):
+        return data.tobytes()
+
+    def encodeString(value):
+        return bytes(value)
+
+class COAPMessage(object):
+    __slots__ = ("version", "type", "code", "id", "token", "options", "host", "port",
+                 "uri_path", "content_format", "payload")
+
     TYPES = ["CON", "NON", "ACK", "RST"]
     CON = 0
     NON = 1
@@ -126,11 +252,6 @@ class COAPMessage():
                 self.port = int(p.port)
             self.uri_path = p.path
         
-    def __getOptionHeader__(self, byte):
-        delta  = (byte & 0xF0) >> 4
-        length = byte & 0x0F
-        return (delta, length)  
-        
     def __str__(self):
         result = []
         result.append("Version: %s" % self.version)
@@ -139,183 +260,141 @@ class COAPMessage():
         result.append("Id: %s" % self.id)
         result.append("Token: %s" % self.token)
         #result.append("Options: %s" % len(self.options))
-        #for option in self.options:
-        #    result.append("+ %d: %s" % (option["number"], option["value"]))
+        #for (number, value) in self.options:
+        #    result.append("+ %d: %s" % (number, value))
         result.append("Uri-Path: %s" % self.uri_path)
         result.append("Content-Format: %s" % (COAPContentFormat.toString(self.content_format) if self.content_format else M_PLAIN))
         result.append("Payload: %s" % self.payload)
         result.append("")
         return '\n'.join(result)
         
-    def getOptionHeaderValue(self, value):
-        if value > 268:
-            return 14
-        if value > 12:
-            return 13
-        return value
-    
-    def getOptionHeaderExtension(self, value):
-        buff = bytearray()
-        v = self.getOptionHeaderValue(value)
-        
-        if v == 14:
-            value -= 269
-            buff.append((value & 0xFF00) >> 8)
-            buff.append(value & 0x00FF)
-
-        elif v == 13:
-            value -= 13
-            buff.append(value)
+    def getOption(self, number):
+        for (optionNumber, value) in self.options:
+            if optionNumber == number:
+                return value
+        return None
 
-        return buff
-    
-    def appendOption(self, buff, lastnumber, option, data):
-        delta = option - lastnumber
-        length = len(data)
-        
-        d = self.getOptionHeaderValue(delta)
-        l = self.getOptionHeaderValue(length)
-        
-        b  = 0
-        b |= (d << 4) & 0xF0  
-        b |= l & 0x0F
-        buff.append(b)
-        
-        ext = self.getOptionHeaderExtension(delta);
-        for b in ext:
-            buff.append(b)
+    def addOption(self, number, value):
+        self.options.append((number, value))
 
-        ext = self.getOptionHeaderExtension(length);
-        for b in ext:
-            buff.append(b)
+    def removeOption(self, number):
+        self.options = [option for option in self.options if option[0] != number]
 
-        for b in data:
-            buff.append(b)
+    def getPayloadBytes(self):
+        if not self.payload:
+            return bytearray()
+        if PYTHON_MAJOR >= 3 and not isinstance(self.payload, (bytes, bytearray)):
+            return bytearray(self.payload.encode())
+        return bytearray(self.payload)
 
-        return option
+    def getOptionBytes(self, value):
+        if isinstance(value, int):
+            return encodeUint(value)
+        elif isinstance(value, (bytes, bytearray)):
+            return bytes(value)
+        return encodeString(value)
 
     def getBytes(self):
-        buff = bytearray()
-        byte  = (self.version & 0x03) << 6
-        byte |= (self.type & 0x03) << 4
-        if self.token:
-            token_len = min(len(self.token), 8);
+        token = self.token
+        if token:
+            token = bytes(token[:8])
         else:
-            token_len = 0
-        byte |= token_len
-        buff.append(byte)
-        buff.append(self.code)
-        buff.append((self.id & 0xFF00) >> 8)
-        buff.append(self.id & 0x00FF)
-        
-        if self.token:
-            for c in self.token:
-                buff.append(c)
+            token = b""
+        chunks = [HEADER.pack(((self.version & 0x03) << 6) | ((self.type & 0x03) << 4) | len(token),
+                              self.code, self.id & 0xFFFF), token]
 
-        lastnumber = 0
-        
-        if len(self.uri_path) > 0:
-            paths = self.uri_path.split("/")
-            for p in paths:
-                if len(p) > 0:
-                    if PYTHON_MAJOR >= 3:
-                        data = p.encode()
-                    else:
-                        data = bytearray(p)
-                    lastnumber = self.appendOption(buff, lastnumber, COAPOption.URI_PATH, data)
+        options = []
+        if self.uri_path:
+            for p in self.uri_path.split("/"):
+                if p:
+                    options.append((COAPOption.URI_PATH, encodeString(p)))
 
         if self.content_format != None:
-            data = bytearray()
-            fmt_code = self.content_format
-            if fmt_code > 0xFF:
-                data.append((fmt_code & 0xFF00) >> 8)
-            data.append(fmt_code & 0x00FF)
-            lastnumber = self.appendOption(buff, lastnumber, COAPOption.CONTENT_FORMAT, data)
-            
-        buff.append(0xFF)
-        
+            options.append((COAPOption.CONTENT_FORMAT, encodeUint(self.content_format)))
+
+        for (number, value) in self.options:
+            if number != COAPOption.URI_PATH and number != COAPOption.CONTENT_FORMAT:
+                options.append((number, self.getOptionBytes(value)))
+
+        # options are sent by increasing number, repeated ones keep their order
+        options.sort(key=lambda option: option[0])
+        lastnumber = 0
+        for (number, data) in options:
+            chunks.append(encodeOptionHeader(number - lastnumber, len(data)))
+            chunks.append(data)
+            lastnumber = number
+
         if self.payload:
-            if PYTHON_MAJOR >= 3:
-                data = self.payload.encode()
+            chunks.append(b"\xff")
+            if isinstance(self.payload, (bytes, bytearray)):
+                chunks.append(bytes(self.payload))
             else:
-                data = bytearray(self.payload)
-            for c in data:
-                buff.append(c)
-        
-        return buff
+                chunks.append(encodeString(self.payload))
+
+        return b"".join(chunks)
     
     def parseByteArray(self, buff):
-        self.version = (buff[0] & 0xC0) >> 6
-        self.type    = (buff[0] & 0x30) >> 4
-        token_length = buff[0] & 0x0F
-        index = 4
-        if token_length > 0:
-            self.token = buff[index:index+token_length]
-
-        index += token_length
-        self.code    = buff[1]
-        self.id      = (buff[2] << 8) | buff[3]
-        
+        (header, self.code, self.id) = HEADER.unpack_from(buff)
+        self.version = header >> 6
+        self.type    = (header >> 4) & 0x03
+        index = 4 + (header & 0x0F)
+        if index > 4:
+            self.token = buff[4:index]
+
+        view = memoryview(buff)
+        size = len(buff)
         number = 0
+        paths = []
+        options = self.options
 
-        # process options
-        while index < len(buff) and buff[index] != 0xFF:
-            (delta, length) = self.__getOptionHeader__(buff[index])
-            offset = 1
+        while index < size:
+            byte = buff[index]
+            if byte == 0xFF:
+                index += 1
+                break
+            delta = byte >> 4
+            length = byte & 0x0F
+            index += 1
 
-            # delta extended with 1 byte
             if delta == 13:
-                delta += buff[index+offset]
-                offset += 1
-            # delta extended with 2 buff
+                delta = 13 + buff[index]
+                index += 1
             elif delta == 14:
-                delta += 255 + ((buff[index+offset] << 8) | buff[index+offset+1])
-                offset += 2
-            
-            # length extended with 1 byte
+                delta = 269 + ((buff[index] << 8) | buff[index+1])
+                index += 2
+
             if length == 13:
-                length += buff[index+offset]
-                offset += 1
-                
-            # length extended with 2 buff
+                length = 13 + buff[index]
+                index += 1
             elif length == 14:
-                length += 255 + ((buff[index+offset] << 8) | buff[index+offset+1])
-                offset += 2
+                length = 269 + ((buff[index] << 8) | buff[index+1])
+                index += 2
 
             number += delta
-            valueBytes = buff[index+offset:index+offset+length]
-            # opaque option value
-            if number in [COAPOption.IF_MATCH, COAPOption.ETAG]:
-                value = valueBytes
-            # integer option value
-            elif number in [COAPOption.URI_PORT, COAPOption.CONTENT_FORMAT, COAPOption.MAX_AGE, COAPOption.ACCEPT]:
-                value = 0
-                for b in valueBytes:
-                    value <<= 8
-                    value |= b
-            # string option value
+            end = index + length
+            if number in INTEGER_OPTIONS:
+                value = decodeUint(view[index:end])
+            elif number in OPAQUE_OPTIONS:
+                value = buff[index:end]
             else:
-                if PYTHON_MAJOR >= 3:
-                    value = valueBytes.decode()
-                else:
-                    value = str(valueBytes)
-            self.options.append({'number': number, 'value': value})
-            index += offset + length
-
-        index += 1 # skip 0xFF / end-of-options
-        
-        if len(buff) > index:
+                value = decodeString(view[index:end])
+                if number == COAPOption.URI_PATH:
+                    paths.append(value)
+            options.append((number, value))
+            index = end
+
+        if index < size:
             self.payload = buff[index:]
         else:
             self.payload = ""
-        
-        for option in self.options:
-            (number, value) = option.values()
-            if number == COAPOption.URI_PATH:
-                self.uri_path += "/%s" % value
+
+        if paths:
+            self.uri_path = "/" + "/".join(paths)
 
 
 class COAPRequest(COAPMessage):
+    __slots__ = ()
+
     CODES = {0: None,
              1: "GET",
              2: "POST",
@@ -332,22 +411,32 @@ class COAPRequest(COAPMessage):
         COAPMessage.__init__(self, msg_type, code, uri)
 
 class COAPGet(COAPRequest):
+    __slots__ = ()
+
     def __init__(self, uri):
         COAPRequest.__init__(self, COAPMessage.CON, COAPRequest.GET, uri)
 
 class COAPPost(COAPRequest):
+    __slots__ = ()
+
     def __init__(self, uri):
         COAPRequest.__init__(self, COAPMessage.CON, COAPRequest.POST, uri)
 
 class COAPPut(COAPRequest):
+    __slots__ = ()
+
     def __init__(self, uri):
         COAPRequest.__init__(self, COAPMessage.CON, COAPRequest.PUT, uri)
 
 class COAPDelete(COAPRequest):
+    __slots__ = ()
+
     def __init__(self, uri):
         COAPRequest.__init__(self, COAPMessage.CON, COAPRequest.DELETE, uri)
 
-class COAPResponse(COAPMessage):    
+class COAPResponse(COAPMessage):
+    __slots__ = ()
+
     CODES = {0: None,
              64: "2.00 OK",
              65: "2.01 Created",
@@ -355,6 +444,7 @@ class COAPResponse(COAPMessage):
              67: "2.03 Valid",
              68: "2.04 Changed",
              69: "2.05 Content",
+             95: "2.31 Continue",
              128: "4.00 Bad Request",
              129: "4.01 Unauthorized",
              130: "4.02 Bad Option",
@@ -362,6 +452,7 @@ class COAPResponse(COAPMessage):
              132: "4.04 Not Found",
              133: "4.05 Method Not Allowed",
              134: "4.06 Not Acceptable",
+             136: "4.08 Request Entity Incomplete",
              140: "4.12 Precondition Failed",
              141: "4.13 Request Entity Too Large",
              143: "4.15 Unsupported Content-Format",
@@ -380,6 +471,7 @@ class COAPResponse(COAPMessage):
     VALID   = 67
     CHANGED = 68
     CONTENT = 69
+    CONTINUE = 95
     
     # 4.XX
     BAD_REQUEST         = 128
@@ -389,6 +481,7 @@ class COAPResponse(COAPMessage):
     NOT_FOUND           = 132
     NOT_ALLOWED         = 133
     NOT_ACCEPTABLE      = 134
+    ENTITY_INCOMPLETE   = 136
     PRECONDITION_FAILED = 140
     ENTITY_TOO_LARGE    = 141
     UNSUPPORTED_CONTENT = 143
@@ -405,24 +498,60 @@ class COAPResponse(COAPMessage):
         COAPMessage.__init__(self)
 
 class COAPClient():
-    def __init__(self):
+    def __init__(self, blockSize=COAP_BLOCK_SIZE):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.settimeout(3.0)
         self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.socket.bind(('', 0))
-        
+        self.blockSZX = getBlockSZX(blockSize)
+        self.messageId = struct.unpack("!H", os.urandom(2))[0]
+
+    def nextMessageId(self):
+        self.messageId = (self.messageId + 1) & 0xFFFF
+        return self.messageId
+
     def sendRequest(self, message):
+        # bodies bigger than a block are sent with Block1, the blocks of a
+        # response are fetched and put back together
+        if len(message.getPayloadBytes()) > 2 ** (self.blockSZX + 4):
+            response = self.sendBlocks(message)
+        else:
+            response = self.exchange(message)
+        if response == None:
+            return None
+        return self.receiveBlocks(message, response)
+
+    def exchange(self, message):
+        message.id = self.nextMessageId()
+        if not message.token:
+            # needed to match a separate response
+            message.token = bytearray(os.urandom(4))
         data = message.getBytes();
         sent = 0
+        separate = False
         while sent<4:
             try:
                 #self.logger.debug("Sending Request:\n")
                 #print ("Sending Request: %d\n" % sent)
-                self.socket.sendto(data, (message.host, message.port))
-                (data, remote_adr) = self.socket.recvfrom(1500)
-                response = COAPResponse()
-                response.parseByteArray(bytearray(data))
+                if not separate:
+                    self.socket.sendto(data, (message.host, message.port))
+                while True:
+                    (received, remote_adr) = self.socket.recvfrom(1500)
+                    response = COAPResponse()
+                    response.parseByteArray(bytearray(received))
+                    if response.code == 0 and response.type == COAPMessage.ACK and response.id == message.id:
+                        # the server acknowledged the request, the response comes apart
+                        separate = True
+                        continue
+                    # skip notifications and late responses of other requests
+                    if response.token == message.token and (response.id == message.id or response.code != 0):
+                        break
+                if response.type == COAPMessage.CON:
+                    ack = COAPResponse()
+                    ack.type = COAPMessage.ACK
+                    ack.id = response.id
+                    self.socket.sendto(ack.getBytes(), remote_adr)
                 #self.logger.debug("Received Response:\n%s" % response)
                 #print ("Received Response: %d\n" % sent)
                 return response
@@ -432,44 +561,648 @@ class COAPClient():
                 #print ("Failed to receive response: %d\n" % sent)
         return None
 
-class COAPServer(threading.Thread):
+    def copyRequest(self, message):
+        request = COAPRequest(message.type, message.code)
+        request.host = message.host
+        request.port = message.port
+        request.uri_path = message.uri_path
+        request.token = message.token
+        request.content_format = message.content_format
+        request.options = [option for option in message.options if not option[0] in
+                           [COAPOption.BLOCK1, COAPOption.BLOCK2, COAPOption.OBSERVE]]
+        return request
+
+    def sendBlocks(self, message):
+        data = message.getPayloadBytes()
+        if not message.token:
+            message.token = bytearray(os.urandom(4))
+        szx = self.blockSZX
+        num = 0
+        while True:
+            size = 2 ** (szx + 4)
+            more = (num + 1) * size < len(data)
+            request = self.copyRequest(message)
+            request.payload = data[num * size:(num + 1) * size]
+            request.addOption(COAPOption.BLOCK1, encodeBlock(num, more, szx))
+            if num == 0:
+                request.addOption(COAPOption.SIZE1, len(data))
+            response = self.exchange(request)
+            if response == None or not more or response.code != COAPResponse.CONTINUE:
+                return response
+            block = response.getOption(COAPOption.BLOCK1)
+            if block != None and decodeBlock(block)[2] < szx:
+                # the server asks for smaller blocks
+                newSZX = decodeBlock(block)[2]
+                num = (num + 1) * 2 ** (szx - newSZX)
+                szx = newSZX
+            else:
+                num += 1
+
+    def receiveBlocks(self, message, response):
+        block = response.getOption(COAPOption.BLOCK2)
+        if block == None:
+            return response
+        data = response.getPayloadBytes()
+        etag = response.getOption(COAPOption.ETAG)
+        (num, more, szx) = decodeBlock(block)
+        while more:
+            request = self.copyRequest(message)
+            request.token = bytearray(os.urandom(4))
+            request.addOption(COAPOption.BLOCK2, encodeBlock(num + 1, False, szx))
+            next = self.exchange(request)
+            if next == None or next.code != COAPResponse.CONTENT or next.getOption(COAPOption.ETAG) != etag:
+                # the resource changed during the transfer
+                return None
+            block = next.getOption(COAPOption.BLOCK2)
+            if block == None:
+                return None
+            (num, more, szx) = decodeBlock(block)
+            data += next.getPayloadBytes()
+        response.payload = data
+        return response
+
+    def observe(self, message):
+        # yields the response then each notification, closing the generator cancels
+        if not message.token:
+            message.token = bytearray(os.urandom(4))
+        message.addOption(COAPOption.OBSERVE, 0)
+        response = self.sendRequest(message)
+        if response == None:
+            return
+        try:
+            yield response
+            sequence = response.getOption(COAPOption.OBSERVE)
+            while sequence != None:
+                try:
+                    (data, remote_adr) = self.socket.recvfrom(1500)
+                except socket.timeout:
+                    continue
+                notification = COAPResponse()
+                notification.parseByteArray(bytearray(data))
+                if notification.token != message.token:
+                    continue
+                if notification.type == COAPMessage.CON:
+                    ack = COAPResponse()
+                    ack.type = COAPMessage.ACK
+                    ack.id = notification.id
+                    self.socket.sendto(ack.getBytes(), remote_adr)
+                if notification.getOption(COAPOption.BLOCK2) != None:
+                    notification = self.receiveBlocks(message, notification)
+                    if notification == None:
+                        continue
+                number = notification.getOption(COAPOption.OBSERVE)
+                if number == None:
+                    # the server ended the observation
+                    yield notification
+                    return
+                # notifications may arrive out of order (RFC 7641 3.4)
+                if (sequence < number < sequence + 0x800000) or (number < sequence - 0x800000):
+                    sequence = number
+                    yield notification
+        finally:
+            cancel = COAPGet("coap://%s:%d%s" % (message.host, message.port, message.uri_path))
+            cancel.token = message.token
+            cancel.addOption(COAPOption.OBSERVE, 1)
+            self.socket.sendto(cancel.getBytes(), (message.host, message.port))
+
+class COAPObservation():
+    def __init__(self, request, client):
+        self.request = request
+        self.client = client
+        self.path = request.uri_path[1:]
+        self.payload = None
+        self.sent = 0
+        self.messageId = None
+
+class COAPObservers(threading.Thread):
+    # observed resources are sampled by the REST state monitor, each change
+    # is rendered once per path and format then sent to its observers
+    def __init__(self, endpoint, monitor, maxAge=OBSERVE_MAX_AGE):
+        threading.Thread.__init__(self, name="COAPObserveThread")
+        self.daemon = True
+        self.endpoint = endpoint
+        self.monitor = monitor
+        self.maxAge = maxAge
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.observations = {}
+        self.subscriptions = {}
+        self.changed = set()
+        self.pending = {}
+        self.sequence = 0
+        self.running = True
+        self.start()
+
+    def register(self, request, response, client):
+        observation = COAPObservation(request, client)
+        observation.payload = response.payload
+        observation.sent = clock()
+        with self.lock:
+            key = (client, bytes(request.token or b""))
+            if key in self.observations:
+                self.removeObservation(key)
+            self.observations[key] = observation
+            path = observation.path
+            if path in self.subscriptions:
+                (subscription, count) = self.subscriptions[path]
+                self.subscriptions[path] = (subscription, count + 1)
+            else:
+                paths = []
+                if path != "*":
+                    paths = [path]
+                subscription = self.monitor.subscribe(lambda event, data: self.onChange(path, event, data), paths)
+                self.subscriptions[path] = (subscription, 1)
+            response.addOption(COAPOption.OBSERVE, self.nextSequence())
+            response.addOption(COAPOption.MAX_AGE, self.maxAge)
+        self.wakeup.set()
+
+    def cancel(self, client, token):
+        with self.lock:
+            self.removeObservation((client, bytes(token or b"")))
+
+    def removeObservation(self, key):
+        observation = self.observations.pop(key, None)
+        if observation == None:
+            return
+        (subscription, count) = self.subscriptions[observation.path]
+        if count > 1:
+            self.subscriptions[observation.path] = (subscription, count - 1)
+        else:
+            del self.subscriptions[observation.path]
+            self.monitor.unsubscribe(subscription)
+
+    def nextSequence(self):
+        self.sequence = (self.sequence + 1) & 0xFFFFFF
+        return self.sequence
+
+    def onChange(self, path, event, data):
+        # called by the monitor thread, only flags the path
+        if (path == "*" and event == "state") or (event == "device" and data["path"] == path):
+            self.changed.add(path)
+            self.wakeup.set()
+
+    def acknowledge(self, message):
+        # empty ACK or RST received from an observer
+        with self.lock:
+            self.pending.pop(message.id, None)
+            if message.type == COAPMessage.RST:
+                for key in list(self.observations.keys()):
+                    if self.observations[key].messageId == message.id:
+                        self.removeObservation(key)
+
+    def run(self):
+        while self.running:
+            with self.lock:
+                idle = len(self.observations) == 0
+            if idle:
+                self.wakeup.wait()
+            else:
+                self.wakeup.wait(1)
+            self.wakeup.clear()
+            try:
+                self.notifyChanges()
+                self.retransmit()
+            except Exception as e:
+                exception(e)
+
+    def notifyChanges(self):
+        changed = set()
+        while len(self.changed) > 0:
+            changed.add(self.changed.pop())
+        now = clock()
+        responses = {}
+        with self.lock:
+            observations = list(self.observations.items())
+        for (key, observation) in observations:
+            refresh = now - observation.sent >= self.maxAge
+            if refresh and observation.messageId in self.pending:
+                # still waiting for the previous refresh to be acknowledged
+                refresh = False
+            if not (observation.path in changed or refresh):
+                continue
+            # observers of a same path and format share the rendering
+            accept = self.endpoint.handler.getAcceptedFormat(observation.request)
+            render = (observation.path, accept)
+            if not render in responses:
+                response = COAPResponse()
+                try:
+                    self.endpoint.handler.do_GET(observation.request, response)
+                except Exception as e:
+                    exception(e)
+                responses[render] = response
+            response = responses[render]
+            if response.payload == observation.payload and not refresh:
+                continue
+            # unchanged resources are refreshed with confirmable notifications
+            # to find out observers that went away
+            self.notify(key, observation, response, refresh)
+
+    def notify(self, key, observation, response, confirmable):
+        notification = COAPResponse()
+        notification.code = response.code
+        notification.payload = response.payload
+        notification.content_format = response.content_format
+        notification.token = observation.request.token
+        notification.id = self.endpoint.nextMessageId()
+        if confirmable:
+            notification.type = COAPMessage.CON
+        else:
+            notification.type = COAPMessage.NON
+        with self.lock:
+            if response.code == COAPResponse.CONTENT:
+                notification.addOption(COAPOption.OBSERVE, self.nextSequence())
+                notification.addOption(COAPOption.MAX_AGE, self.maxAge)
+            else:
+                # an error ends the observation
+                self.removeObservation(key)
+            observation.payload = response.payload
+            observation.sent = clock()
+            observation.messageId = notification.id
+            # big notifications carry their first block, observers fetch the others
+            self.endpoint.sliceBlock(observation.request, notification)
+            data = notification.getBytes()
+            if confirmable:
+                self.pending[notification.id] = [key, data, 0, clock() + ACK_TIMEOUT]
+        self.endpoint.sendDatagram(data, observation.client)
+
+    def retransmit(self):
+        now = clock()
+        with self.lock:
+            for messageId in list(self.pending.keys()):
+                (key, data, retries, deadline) = self.pending[messageId]
+                if deadline > now:
+                    continue
+                observation = self.observations.get(key)
+                if observation == None or retries >= MAX_RETRANSMIT:
+                    del self.pending[messageId]
+                    self.removeObservation(key)
+                    continue
+                self.pending[messageId] = [key, data, retries + 1, now + ACK_TIMEOUT * (2 ** (retries + 1))]
+                self.endpoint.sendDatagram(data, observation.client)
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+        with self.lock:
+            for key in list(self.observations.keys()):
+                self.removeObservation(key)
+
+class COAPScheduler(threading.Thread):
+    # runs delayed ACKs and retransmissions on a single thread
+    def __init__(self):
+        threading.Thread.__init__(self, name="COAPSchedulerThread")
+        self.daemon = True
+        self.tasks = []
+        self.count = 0
+        self.condition = threading.Condition()
+        self.running = True
+        self.start()
+
+    def schedule(self, delay, func, *args):
+        # returns the task, cancel it by setting task[2] to None
+        with self.condition:
+            self.count += 1
+            task = [clock() + delay, self.count, func, args]
+            heapq.heappush(self.tasks, task)
+            self.condition.notify()
+            return task
+
+    def run(self):
+        while self.running:
+            with self.condition:
+                while self.running and (len(self.tasks) == 0 or self.tasks[0][0] > clock()):
+                    if len(self.tasks) == 0:
+                        self.condition.wait()
+                    else:
+                        self.condition.wait(self.tasks[0][0] - clock())
+                if not self.running:
+                    break
+                (when, count, func, args) = heapq.heappop(self.tasks)
+            if func != None:
+                try:
+                    func(*args)
+                except Exception as e:
+                    exception(e)
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+class COAPExchange():
+    def __init__(self, request, client):
+        self.request = request
+        self.client = client
+        self.acknowledged = False
+        self.done = False
+
+class COAPEndpoint():
     logger = logging.getLogger("CoAP")
 
-    def __init__(self, host, port, handler):
-        threading.Thread.__init__(self, name="COAPThread")
+    def __init__(self, handler, observeMaxAge=OBSERVE_MAX_AGE, blockSize=COAP_BLOCK_SIZE, ackDelay=COAP_ACK_DELAY):
         self.handler = COAPHandler(handler)
+        self.observeMaxAge = observeMaxAge
+        self.blockSZX = getBlockSZX(blockSize)
+        self.ackDelay = ackDelay
+        self.representations = LRUCache(32, BLOCK_CACHE_TTL)
+        self.uploads = LRUCache(32, BLOCK_CACHE_TTL)
+        self.exchanges = LRUCache(EXCHANGE_CACHE_SIZE, EXCHANGE_LIFETIME)
+        self.observers = None
+        self.scheduler = None
+        self.confirmables = {}
+        self.lock = threading.Lock()
+        self.messageId = struct.unpack("!H", os.urandom(2))[0]
+
+    def getScheduler(self):
+        with self.lock:
+            if self.scheduler == None:
+                self.scheduler = COAPScheduler()
+            return self.scheduler
+
+    def nextMessageId(self):
+        with self.lock:
+            self.messageId = (self.messageId + 1) & 0xFFFF
+            return self.messageId
+
+    def sendDatagram(self, data, client):
+        raise NotImplementedError
+
+    def processDatagram(self, request, client):
+        # returns the response bytes, None when nothing has to be answered
+        if len(request) < 4:
+            return None
+        (header, code, messageId) = struct.unpack_from("!BBH", request)
+        if code == 0:
+            return self.processEmpty(self.parseRequest(request))
+
+        # retransmitted requests are answered again without being processed
+        key = (client, messageId)
+        with self.lock:
+            replay = self.exchanges.get(key)
+            if replay == None:
+                self.exchanges.set(key, False)
+        if replay == False:
+            # still being processed
+            return None
+        elif replay != None:
+            return replay
+
+        try:
+            (responseBytes, replay) = self.processRequestMessage(self.parseRequest(request), client)
+        except:
+            self.exchanges.remove(key)
+            raise
+        self.exchanges.set(key, replay)
+        return responseBytes
+
+    def parseRequest(self, request):
+        coapRequest = COAPRequest()
+        coapRequest.parseByteArray(bytearray(request))
+        return coapRequest
+
+    def processRequestMessage(self, coapRequest, client):
+        # returns the response bytes and the ones to send again to a retransmission
+        coapResponse = COAPResponse()
+        self.logger.debug("Received Request:\n%s" % coapRequest)
+        exchange = None
+        if coapRequest.type == COAPMessage.CON and self.ackDelay > 0:
+            # stops the client retransmitting while a slow device is read
+            exchange = COAPExchange(coapRequest, client)
+            task = self.getScheduler().schedule(self.ackDelay, self.acknowledgeLate, exchange)
+        try:
+            self.processMessage(coapRequest, coapResponse, client)
+            if coapRequest.code == COAPRequest.GET:
+                self.processObserve(coapRequest, coapResponse, client)
+                self.sliceBlock(coapRequest, coapResponse)
+        except Exception as e:
+            # the client may have been acknowledged already, it still needs a response
+            exception(e)
+            coapResponse = COAPResponse()
+            coapResponse.type = COAPMessage.ACK if coapRequest.type == COAPMessage.CON else COAPMessage.NON
+            coapResponse.id = coapRequest.id
+            coapResponse.token = coapRequest.token
+            coapResponse.code = COAPResponse.INTERNAL_ERROR
+        if exchange != None:
+            with self.lock:
+                task[2] = None
+                exchange.done = True
+            if exchange.acknowledged:
+                coapResponse.type = COAPMessage.CON
+                coapResponse.id = self.nextMessageId()
+        self.logger.debug("Sending Response:\n%s" % coapResponse)
+        responseBytes = coapResponse.getBytes()
+        replay = responseBytes
+        if exchange != None and exchange.acknowledged:
+            self.sendConfirmable(coapResponse.id, responseBytes, client, False)
+            replay = self.getEmptyACK(coapRequest.id)
+        self.logger.debug('"%s %s CoAP/%.1f" - %s (Client: %s)' % (coapRequest.CODES[coapRequest.code], coapRequest.uri_path, coapRequest.version, coapResponse.CODES[coapResponse.code], client[0]))
+        return (responseBytes, replay)
+
+    def processMessage(self, request, response, client=None):
+        if request.type == COAPMessage.CON:
+            response.type = COAPMessage.ACK
+        else:
+            response.type = COAPMessage.NON
+
+        if request.token:
+            response.token = request.token
+
+        response.id = request.id
+        response.uri_path = request.uri_path
+        
+        if request.code == COAPRequest.GET:
+            if not self.getRepresentation(request, response):
+                self.handler.do_GET(request, response)
+        elif request.code == COAPRequest.POST:
+            if self.receiveBlock(request, response, client):
+                self.handler.do_POST(request, response)
+        elif request.code / 32 == 0:
+            response.code = COAPResponse.NOT_IMPLEMENTED
+        else:
+            exception(Exception("Received CoAP Response : %s" % response))
+
+    def getRepresentationKey(self, request):
+        return (request.uri_path, self.handler.getAcceptedFormat(request))
+
+    def getRepresentation(self, request, response):
+        # blocks after the first one are cut from the serialized response
+        block = request.getOption(COAPOption.BLOCK2)
+        if block == None or decodeBlock(block)[0] == 0:
+            return False
+        representation = self.representations.get(self.getRepresentationKey(request))
+        if representation == None:
+            return False
+        (response.code, response.payload, response.content_format) = representation
+        return True
+
+    def sliceBlock(self, request, response):
+        if response.code != COAPResponse.CONTENT:
+            return
+        data = response.getPayloadBytes()
+        szx = self.blockSZX
+        num = 0
+        block = request.getOption(COAPOption.BLOCK2)
+        if block != None:
+            (num, more, requestSZX) = decodeBlock(block)
+            if requestSZX < szx:
+                szx = requestSZX
+            else:
+                num *= 2 ** (requestSZX - szx)
+        size = 2 ** (szx + 4)
+        if block == None and len(data) <= size:
+            return
+        if num * size >= len(data) and num > 0:
+            response.code = COAPResponse.BAD_OPTION
+            response.payload = "Block out of range"
+            response.content_format = None
+            return
+        self.representations.set(self.getRepresentationKey(request), (response.code, data, response.content_format))
+        response.payload = data[num * size:(num + 1) * size]
+        response.addOption(COAPOption.BLOCK2, encodeBlock(num, (num + 1) * size < len(data), szx))
+        response.addOption(COAPOption.ETAG, struct.pack("!I", zlib.crc32(bytes(data)) & 0xFFFFFFFF))
+        if num == 0:
+            response.addOption(COAPOption.SIZE2, len(data))
+
+    def receiveBlock(self, request, response, client):
+        # returns True when the request body is complete
+        block = request.getOption(COAPOption.BLOCK1)
+        if block == None:
+            return True
+        (num, more, szx) = decodeBlock(block)
+        size = 2 ** (szx + 4)
+        # the token may change between blocks, concurrent uploads are told apart by their Request-Tag
+        tag = request.getOption(COAPOption.REQUEST_TAG)
+        key = (client, request.uri_path, None if tag == None else bytes(tag))
+        if num == 0:
+            body = bytearray()
+        else:
+            body = self.uploads.get(key)
+            if body == None or len(body) != num * size:
+                response.code = COAPResponse.ENTITY_INCOMPLETE
+                return False
+        body += request.getPayloadBytes()
+        if len(body) > BLOCK_MAX_BODY:
+            self.uploads.remove(key)
+            response.code = COAPResponse.ENTITY_TOO_LARGE
+            response.addOption(COAPOption.SIZE1, BLOCK_MAX_BODY)
+            return False
+        response.addOption(COAPOption.BLOCK1, encodeBlock(num, more, szx))
+        if more:
+            self.uploads.set(key, body)
+            response.code = COAPResponse.CONTINUE
+            return False
+        self.uploads.remove(key)
+        request.payload = body
+        return True
+
+    def getEmptyACK(self, messageId):
+        ack = COAPResponse()
+        ack.type = COAPMessage.ACK
+        ack.id = messageId
+        return ack.getBytes()
+
+    def acknowledgeLate(self, exchange):
+        with self.lock:
+            if exchange.done:
+                return
+            exchange.acknowledged = True
+        self.sendDatagram(self.getEmptyACK(exchange.request.id), exchange.client)
+
+    def sendConfirmable(self, messageId, data, client, send=True):
+        # retransmitted until acknowledged (RFC 7252 4.2)
+        with self.lock:
+            self.confirmables[messageId] = [data, client, 0]
+        if send:
+            self.sendDatagram(data, client)
+        self.getScheduler().schedule(ACK_TIMEOUT, self.retransmit, messageId)
+
+    def retransmit(self, messageId):
+        with self.lock:
+            confirmable = self.confirmables.get(messageId)
+            if confirmable == None:
+                return
+            if confirmable[2] >= MAX_RETRANSMIT:
+                del self.confirmables[messageId]
+                return
+            confirmable[2] += 1
+            (data, client, retries) = confirmable
+        self.sendDatagram(data, client)
+        self.getScheduler().schedule(ACK_TIMEOUT * 2 ** retries, self.retransmit, messageId)
+
+    def processEmpty(self, message):
+        if message.type == COAPMessage.CON:
+            # CoAP ping
+            reset = COAPResponse()
+            reset.type = COAPMessage.RST
+            reset.id = message.id
+            return reset.getBytes()
+        with self.lock:
+            self.confirmables.pop(message.id, None)
+        if self.observers != None:
+            self.observers.acknowledge(message)
+        return None
+
+    def processObserve(self, request, response, client):
+        observe = request.getOption(COAPOption.OBSERVE)
+        monitor = self.handler.handler.monitor
+        if observe == 0 and response.code == COAPResponse.CONTENT and monitor != None:
+            with self.lock:
+                if self.observers == None:
+                    self.observers = COAPObservers(self, monitor, self.observeMaxAge)
+            self.observers.register(request, response, client)
+        elif self.observers != None:
+            # a GET without Observe also ends a previous observation
+            self.observers.cancel(client, request.token)
+
+    def stop(self):
+        if self.observers != None:
+            self.observers.stop()
+        if self.scheduler != None:
+            self.scheduler.stop()
+
+def createServerSocket(port):
+    if socket.has_ipv6:
+        address_family = socket.AF_INET6
+    else:
+        address_family = socket.AF_INET
+    try:
+        sock = socket.socket(address_family, socket.SOCK_DGRAM)
+    except:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('', port))
+    return sock
+
+def joinMulticastGroup(sock, multicast_ip):
+    mreq = struct.pack("4sl", socket.inet_aton(multicast_ip), socket.INADDR_ANY)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+
+class COAPServer(COAPEndpoint, threading.Thread):
+    def __init__(self, host, port, handler, workers=4, queueSize=16, **options):
+        threading.Thread.__init__(self, name="COAPThread")
+        COAPEndpoint.__init__(self, handler, **options)
         self.host = host
         self.port = port
         self.multicast_ip = '224.0.1.123'
-        if socket.has_ipv6:
-            address_family = socket.AF_INET6
-        else:
-            address_family = socket.AF_INET
-        try:
-            self.socket = socket.socket(address_family, socket.SOCK_DGRAM)
-        except:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.socket.bind(('', port))
+        self.socket = createServerSocket(port)
         self.socket.settimeout(3)
+        self.pool = None
+        if workers > 0:
+            self.pool = WorkerPool("COAPWorker", workers, queueSize)
         self.running = True
         self.start()
         
     def run(self):
         info("CoAP Server binded on coap://%s:%s/" % (self.host, self.port))
+        if self.pool != None:
+            info("CoAP Server using %d workers" % len(self.pool.threads))
         while self.running == True:
             try:
                 (request, client) = self.socket.recvfrom(1500)
-                requestBytes = bytearray(request)
-                coapRequest = COAPRequest()
-                coapRequest.parseByteArray(requestBytes)
-                coapResponse = COAPResponse()
-                self.logger.debug("Received Request:\n%s" % coapRequest)
-                self.processMessage(coapRequest, coapResponse)
-                self.logger.debug("Sending Response:\n%s" % coapResponse)
-                responseBytes = coapResponse.getBytes()
-                self.socket.sendto(responseBytes, client)
-                self.logger.debug('"%s %s CoAP/%.1f" - %s (Client: %s)' % (coapRequest.CODES[coapRequest.code], coapRequest.uri_path, coapRequest.version, coapResponse.CODES[coapResponse.code], client[0]))
+                if self.pool == None:
+                    self.processRequest(request, client)
+                elif not self.pool.submit(self.processRequest, request, client):
+                    self.rejectRequest(request, client)
                 
             except socket.timeout as e:
                 continue
@@ -478,44 +1211,56 @@ class COAPServer(threading.Thread):
                     exception(e)
             
         info("CoAP Server stopped")
+
+    def processRequest(self, request, client):
+        responseBytes = self.processDatagram(request, client)
+        if responseBytes != None:
+            self.socket.sendto(responseBytes, client)
+
+    def rejectRequest(self, request, client):
+        # all workers busy, tell the client when to retry
+        coapRequest = COAPRequest()
+        coapRequest.parseByteArray(bytearray(request))
+        if coapRequest.code == 0 or coapRequest.type != COAPMessage.CON:
+            return
+        response = COAPResponse()
+        response.type = COAPMessage.ACK
+        response.id = coapRequest.id
+        response.token = coapRequest.token
+        response.code = COAPResponse.SERVICE_UNAVAILABLE
+        response.addOption(COAPOption.MAX_AGE, 1)
+        self.socket.sendto(response.getBytes(), client)
     
     def enableMulticast(self):
         while not self.running:
             pass
-        mreq = struct.pack("4sl", socket.inet_aton(self.multicast_ip), socket.INADDR_ANY)
-        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        joinMulticastGroup(self.socket, self.multicast_ip)
         info("CoAP Server binded on coap://%s:%s/ (MULTICAST)" % (self.multicast_ip, self.port))
                 
+    def sendDatagram(self, data, client):
+        self.socket.sendto(data, client)
+
     def stop(self):
         self.running = False
+        COAPEndpoint.stop(self)
+        if self.pool != None:
+            self.pool.stop()
         self.socket.close()
         
-    def processMessage(self, request, response):
-        if request.type == COAPMessage.CON:
-            response.type = COAPMessage.ACK
-        else:
-            response.type = COAPMessage.NON
-
-        if request.token:
-            response.token = request.token
-
-        response.id = request.id
-        response.uri_path = request.uri_path
-        
-        if request.code == COAPRequest.GET:
-            self.handler.do_GET(request, response)
-        elif request.code == COAPRequest.POST:
-            self.handler.do_POST(request, response)
-        elif request.code / 32 == 0:
-            response.code = COAPResponse.NOT_IMPLEMENTED
-        else:
-            exception(Exception("Received CoAP Response : %s" % response))
-        
 class COAPHandler():
     def __init__(self, handler):
         self.handler = handler
+
+    def getAcceptedFormat(self, request):
+        for (number, value) in request.options:
+            if number == COAPOption.ACCEPT:
+                fmt = COAPContentFormat.FORMATS.get(value)
+                if fmt in SERIALIZERS:
+                    return fmt
+        return None
     
     def do_GET(self, request, response):
+        self.handler.setFormat(self.getAcceptedFormat(request))
         try:
             (code, body, contentType) = self.handler.do_GET(request.uri_path[1:], True)
             if code == 0:
@@ -534,12 +1279,19 @@ class COAPHandler():
             raise e
         
     def do_POST(self, request, response):
+        self.handler.setFormat(self.getAcceptedFormat(request))
         try:
             (code, body, contentType) = self.handler.do_POST(request.uri_path[1:], request.payload, True)
             if code == 0:
                 response.code = COAPResponse.NOT_FOUND
             elif code == 200:
                 response.code = COAPResponse.CHANGED
+            elif code == 202:
+                # asynchronous macros create a job, polled at its location
+                response.code = COAPResponse.CREATED
+                job = json.loads(body)
+                for segment in ["macros", "jobs", job["id"]]:
+                    response.addOption(COAPOption.LOCATION_PATH, segment)
             else:
                 response.code =  HTTPCode2CoAPCode(code)
             response.payload = body
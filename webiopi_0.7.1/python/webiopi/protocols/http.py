@@ -12,24 +12,41 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import io
 import os
+import math
+import errno
 import socket
+import select
 import threading
 import codecs
 import mimetypes as mime
 import logging
+import zlib
+import binascii
+import struct
+from email.utils import formatdate, parsedate_tz, mktime_tz
 
 from webiopi.utils.version import VERSION_STRING, PYTHON_MAJOR
-from webiopi.utils.logger import info, exception
+from webiopi.utils.logger import info, warn, exception
 from webiopi.utils.crypto import encrypt
-from webiopi.utils.types import str2bool
+from webiopi.utils.types import str2bool, jsonDumps, matchETag, SERIALIZERS
+from webiopi.utils.thread import WorkerPool
+from webiopi.utils.cache import LRUCache, clock
+from webiopi.protocols import websocket
 
 if PYTHON_MAJOR >= 3:
     import http.server as BaseHTTPServer
     from urllib.parse import unquote as uqot # Added by Rgg to handle requests containing percent-encoded chars
+    from urllib.parse import urlparse
+    from html import escape
+    import queue as Queue
 else:
     import BaseHTTPServer
     from urllib import unquote as uqot # Added by Rgg to handle requests containing percent-encoded chars
+    from urlparse import urlparse
+    from cgi import escape
+    import Queue
 
 try :
     import _webiopi.GPIO as GPIO
@@ -38,18 +55,69 @@ except:
 
 WEBIOPI_DOCROOT = "/usr/share/webiopi/htdocs"
 
-class HTTPServer(BaseHTTPServer.HTTPServer, threading.Thread):
-    if socket.has_ipv6:
-        address_family = socket.AF_INET6
+# seconds before a cached file is checked again on the SD card
+ASSET_CHECK_INTERVAL = 2
 
-    def __init__(self, host, port, handler, context, docroot, index, auth=None, realm=None):
-        try:
-            BaseHTTPServer.HTTPServer.__init__(self, ("", port), HTTPHandler)
-        except:
-            self.address_family = socket.AF_INET
-            BaseHTTPServer.HTTPServer.__init__(self, ("", port), HTTPHandler)
+# seconds before the passwd file is checked again for changes
+AUTH_CHECK_INTERVAL = 2
 
-        threading.Thread.__init__(self, name="HTTPThread")
+SESSION_COOKIE = "webiopi-session"
+
+# seconds between keep-alive comments on idle event streams
+EVENTS_PING_INTERVAL = 15
+
+# frames waiting for a slow WebSocket client before it is disconnected
+WEBSOCKET_QUEUE_SIZE = 64
+
+# longest wait allowed to a long-polling request
+LONG_POLL_MAX_WAIT = 60
+
+# seconds between checks of the worker pool while a persistent connection is idle
+KEEP_ALIVE_POLL_INTERVAL = 0.2
+
+# REST responses depend on both the format and the encoding accepted by the client
+NEGOTIATED_HEADERS = "Accept, Accept-Encoding"
+
+GZIP_TYPES = ["application/javascript", "application/json", "application/xml", "image/svg+xml"]
+
+def gzipCompress(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def formatEvent(event, data):
+    lines = ["event: %s" % event]
+    for line in jsonDumps(data).split("\n"):
+        lines.append("data: %s" % line)
+    return ("\n".join(lines) + "\n\n").encode()
+
+def isCompressible(contentType):
+    if contentType == None:
+        return False
+    contentType = contentType.split(";")[0]
+    return contentType.startswith("text/") or contentType in GZIP_TYPES
+
+class HTTPAsset():
+    def __init__(self, path, stat):
+        self.path = path
+        (self.contentType, encoding) = mime.guess_type(path)
+        if self.contentType == None:
+            self.contentType = "application/octet-stream"
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self.etag = '"%x-%x"' % (int(self.mtime * 1000000), self.size)
+        self.lastModified = formatdate(self.mtime, usegmt=True)
+        self.checked = clock()
+        self.data = None
+        self.gzipData = None
+        self.gzipETag = self.etag[:-1] + '-gz"'
+
+    def isModified(self, stat):
+        return stat.st_size != self.size or stat.st_mtime != self.mtime
+
+class HTTPContext():
+    def __init__(self, host, port, handler, context, docroot, index, auth=None, realm=None, timeout=10,
+                 keepAlive=True, keepAliveTimeout=5, keepAliveRequests=100, cacheSize=2048,
+                 gzip=True, gzipMinSize=1024, passwdFile=None, authCacheTTL=300, sessionTTL=0, origins=[]):
         self.host = host
         self.port = port
 
@@ -71,20 +139,164 @@ class HTTPServer(BaseHTTPServer.HTTPServer, threading.Thread):
 
         self.handler = handler
         self.auth = auth
+        self.authFile = passwdFile
+        self.authFileMTime = self.getAuthFileMTime()
+        self.authChecked = clock()
+        if authCacheTTL > 0:
+            self.authCache = LRUCache(32, authCacheTTL)
+        else:
+            self.authCache = None
+        # other sites allowed to open WebSockets, besides the one served
+        self.origins = [origin.rstrip("/").lower() for origin in origins]
+        if sessionTTL > 0:
+            self.sessions = LRUCache(256, sessionTTL)
+        else:
+            self.sessions = None
         if (realm == None):
             self.authenticateHeader = "Basic realm=webiopi"
         else:
             self.authenticateHeader = "Basic realm=%s" % realm
 
+        self.timeout = timeout
+        self.keepAlive = keepAlive
+        self.keepAliveTimeout = keepAliveTimeout
+        self.keepAliveRequests = keepAliveRequests
+
+        # cacheSize is given in kilobytes, files bigger than a quarter of it are always read from disk
+        self.assets = LRUCache(256, maxWeight=cacheSize * 1024)
+        self.assetMaxSize = cacheSize * 256
+
+        self.gzip = gzip
+        self.gzipMinSize = gzipMinSize
+
+        # an event stream holds its connection until the client leaves
+        self.streaming = True
         self.running = True
+
+    def acquireStream(self):
+        return self.streaming
+
+    def releaseStream(self):
+        pass
+
+    def getAuthFileMTime(self):
+        try:
+            return os.stat(self.authFile).st_mtime
+        except (OSError, TypeError):
+            return None
+
+    def getAuth(self):
+        if self.authFile == None or clock() - self.authChecked < AUTH_CHECK_INTERVAL:
+            return self.auth
+        self.authChecked = clock()
+        mtime = self.getAuthFileMTime()
+        if mtime == self.authFileMTime:
+            return self.auth
+
+        self.authFileMTime = mtime
+        auth = ""
+        if mtime != None:
+            try:
+                f = open(self.authFile)
+                auth = f.read().strip(" \r\n")
+                f.close()
+            except IOError:
+                pass
+        if len(auth) == 0:
+            # webiopi-passwd truncates the file before asking for the new login,
+            # never let that switch authentication off
+            warn("Passwd file %s is missing or empty, keeping the previous credentials" % self.authFile)
+            return self.auth
+
+        # forget verified credentials and sessions when the passwd file changes
+        info("Reloading passwd file %s" % self.authFile)
+        if self.authCache != None:
+            self.authCache.clear()
+        if self.sessions != None:
+            self.sessions.clear()
+        self.auth = auth
+        return auth
+
+class HTTPServer(BaseHTTPServer.HTTPServer, HTTPContext, threading.Thread):
+    if socket.has_ipv6:
+        address_family = socket.AF_INET6
+
+    def __init__(self, host, port, handler, context, docroot, index, auth=None, realm=None, workers=0, queueSize=16, timeout=10,
+                 keepAlive=True, keepAliveTimeout=5, keepAliveRequests=100, cacheSize=2048,
+                 gzip=True, gzipMinSize=1024, passwdFile=None, authCacheTTL=300, sessionTTL=0, origins=[], maxStreams=-1):
+        try:
+            BaseHTTPServer.HTTPServer.__init__(self, ("", port), HTTPHandler)
+        except:
+            self.address_family = socket.AF_INET
+            BaseHTTPServer.HTTPServer.__init__(self, ("", port), HTTPHandler)
+
+        threading.Thread.__init__(self, name="HTTPThread")
+        HTTPContext.__init__(self, host, port, handler, context, docroot, index, auth, realm, timeout,
+                             keepAlive, keepAliveTimeout, keepAliveRequests, cacheSize,
+                             gzip, gzipMinSize, passwdFile, authCacheTTL, sessionTTL, origins)
+
+        # each stream holds a worker, some are always left to other requests
+        if maxStreams < 0 or maxStreams >= workers:
+            maxStreams = workers // 2
+        self.maxStreams = maxStreams
+        self.streams = 0
+        self.streamsLock = threading.Lock()
+
+        if workers > 0:
+            self.pool = WorkerPool("HTTPWorker", workers, queueSize)
+            self.streaming = maxStreams > 0
+        else:
+            # an idle persistent connection would stall the single HTTP thread
+            self.pool = None
+            self.keepAlive = False
+            self.streaming = False
+
         self.start()
 
+    def acquireStream(self):
+        with self.streamsLock:
+            if self.streams >= self.maxStreams:
+                return False
+            self.streams += 1
+            return True
+
+    def releaseStream(self):
+        with self.streamsLock:
+            self.streams -= 1
+
+    def isSaturated(self):
+        return self.pool != None and self.pool.isSaturated()
+
     def get_request(self):
         sock, addr = self.socket.accept()
-        sock.settimeout(10.0)
+        sock.settimeout(self.timeout)
         return (sock, addr)
 
+    def process_request(self, request, client_address):
+        if self.pool == None:
+            return BaseHTTPServer.HTTPServer.process_request(self, request, client_address)
+        if not self.pool.submit(self.process_request_worker, request, client_address):
+            self.reject_request(request, client_address)
+
+    def process_request_worker(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def reject_request(self, request, client_address):
+        HTTPHandler.logger.debug("Queue full, rejecting request (Client: %s)" % client_address[0])
+        try:
+            request.sendall(b"HTTP/1.0 503 Service Unavailable\r\nRetry-After: 1\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+        except socket.error:
+            pass
+        self.shutdown_request(request)
+
     def run(self):
+        if self.pool != None:
+            info("HTTP Server using %d workers" % len(self.pool.threads))
         info("HTTP Server binded on http://%s:%s%s" % (self.host, self.port, self.context))
         try:
             self.serve_forever()
@@ -97,9 +309,49 @@ class HTTPServer(BaseHTTPServer.HTTPServer, threading.Thread):
         self.running = False
         self.shutdown()
         self.server_close()
+        if self.pool != None:
+            self.pool.stop()
+
+class RequestReader(io.RawIOBase):
+    # reads from the client socket, the socket timeout is lowered on each read
+    # to the time left until the deadline of the request
+    def __init__(self, sock):
+        self.sock = sock
+        self.deadline = None
+        self.expired = False
+
+    def readable(self):
+        return True
+
+    def setDeadline(self, deadline):
+        self.deadline = deadline
+        self.expired = False
+
+    def readinto(self, buff):
+        if self.deadline != None:
+            remaining = self.deadline - clock()
+            if remaining <= 0:
+                self.expired = True
+                raise socket.timeout("Request timeout")
+            self.sock.settimeout(remaining)
+        try:
+            return self.sock.recv_into(buff)
+        except socket.timeout:
+            self.expired = self.deadline != None
+            raise
+        except socket.error as e:
+            if e.args[0] in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                return None
+            raise
 
 class HTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     logger = logging.getLogger("HTTP")
+    protocol_version = "HTTP/1.1"
+    requestCount = 0
+    unreadBody = False
+    sessionToken = None
+    requestParsed = False
+    reader = None
 
     def log_message(self, fmt, *args):
         pass
@@ -110,10 +362,116 @@ class HTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     def version_string(self):
         return VERSION_STRING
 
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.rfile.close()
+        self.reader = RequestReader(self.connection)
+        self.rfile = io.BufferedReader(self.reader)
+
+    def handle(self):
+        self.close_connection = True
+        self.handleRequest()
+        while not self.close_connection and self.waitNextRequest():
+            self.requestParsed = False
+            self.handleRequest()
+
+    def handleRequest(self):
+        # the whole request must be received within the server timeout
+        count = self.requestCount
+        self.reader.setDeadline(clock() + self.server.timeout)
+        self.handle_one_request()
+        if self.reader.expired and self.requestCount == count:
+            self.close_connection = True
+            if not self.requestParsed:
+                (self.requestline, self.request_version, self.command) = ("", "", "")
+            try:
+                self.send_error(408)
+            except socket.error:
+                pass
+
+    def hasBufferedData(self):
+        # a pipelined request may already be read from the socket
+        self.reader.setDeadline(None)
+        self.request.settimeout(0)
+        return len(self.rfile.peek(1)) > 0
+
+    def waitNextRequest(self):
+        # an idle persistent connection gives its worker back as soon as other requests need it
+        if self.hasBufferedData():
+            return True
+        deadline = clock() + self.server.keepAliveTimeout
+        while True:
+            remaining = deadline - clock()
+            if remaining <= 0 or self.server.isSaturated():
+                return False
+            (readable, writable, errors) = select.select([self.request], [], [], min(remaining, KEEP_ALIVE_POLL_INTERVAL))
+            if len(readable) > 0:
+                return True
+
+    def parse_request(self):
+        self.requestParsed = False
+        if not BaseHTTPServer.BaseHTTPRequestHandler.parse_request(self):
+            return False
+        self.requestParsed = True
+        length = self.headers.get('Content-Length')
+        self.unreadBody = (length != None and length.strip() != "0") or ('Transfer-Encoding' in self.headers)
+        return True
+
+    def send_response(self, code, message=None):
+        if self.reader != None:
+            self.reader.setDeadline(None)
+        BaseHTTPServer.BaseHTTPRequestHandler.send_response(self, code, message)
+        self.requestCount += 1
+        # a request body left in the stream would be read as the next request
+        if not self.server.keepAlive or self.requestCount >= self.server.keepAliveRequests or self.unreadBody or self.close_connection:
+            self.send_header("Connection", "close")
+        elif self.request_version == "HTTP/1.0":
+            self.send_header("Connection", "keep-alive")
+        if self.sessionToken != None:
+            self.send_header("Set-Cookie", "%s=%s; Path=/; HttpOnly" % (SESSION_COOKIE, self.sessionToken))
+            self.sessionToken = None
+
+    def send_error(self, code, message=None, explain=None):
+        try:
+            (short, longmsg) = self.responses[code]
+        except KeyError:
+            (short, longmsg) = ("???", "???")
+        if message == None:
+            message = short
+        if explain == None:
+            explain = longmsg
+        # the stream cannot be trusted after an error raised while parsing the request
+        if not self.requestParsed:
+            self.close_connection = True
+        content = self.error_message_format % {'code': code, 'message': escape(message), 'explain': escape(explain)}
+        content = content.encode("UTF-8", "replace")
+        self.send_response(code)
+        self.send_header("Content-Type", self.error_content_type)
+        self.send_header("Content-Length", len(content))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(content)
+
+    def getSessionToken(self):
+        cookies = self.headers.get('Cookie')
+        if cookies == None:
+            return None
+        for cookie in cookies.split(";"):
+            (name, sep, value) = cookie.strip().partition("=")
+            if name == SESSION_COOKIE:
+                return value
+        return None
+
     def checkAuthentication(self):
-        if self.server.auth == None or len(self.server.auth) == 0:
+        serverAuth = self.server.getAuth()
+        if serverAuth == None or len(serverAuth) == 0:
             return True
 
+        if self.server.sessions != None:
+            token = self.getSessionToken()
+            if token != None and self.server.sessions.get(token) != None:
+                return True
+
         authHeader = self.headers.get('Authorization')
         if authHeader == None:
             return False
@@ -121,41 +479,113 @@ class HTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         if not authHeader.startswith("Basic "):
             return False
 
-        auth = authHeader.replace("Basic ", "")
-        if PYTHON_MAJOR >= 3:
-            auth_hash = encrypt(auth.encode())
-        else:
-            auth_hash = encrypt(auth)
+        if self.server.authCache == None or self.server.authCache.get(authHeader) == None:
+            auth = authHeader.replace("Basic ", "")
+            if PYTHON_MAJOR >= 3:
+                auth_hash = encrypt(auth.encode())
+            else:
+                auth_hash = encrypt(auth)
 
-        if auth_hash == self.server.auth:
-            return True
-        return False
+            if auth_hash != serverAuth:
+                return False
+            if self.server.authCache != None:
+                self.server.authCache.set(authHeader, True)
+
+        if self.server.sessions != None:
+            self.sessionToken = binascii.hexlify(os.urandom(16)).decode()
+            self.server.sessions.set(self.sessionToken, True)
+        return True
 
     def requestAuthentication(self):
         self.send_response(401)
         self.send_header("WWW-Authenticate", self.server.authenticateHeader)
+        self.send_header("Content-Length", 0)
         self.end_headers();
 
     def logRequest(self, code):
         self.logger.debug('"%s %s %s" - %s %s (Client: %s)' % (self.command, self.path, self.request_version, code, self.responses[code][0], self.client_address[0] ))
 
-    def sendResponse(self, code, body=None, contentType="text/plain"):
+    def sendResponse(self, code, body=None, contentType="text/plain", headers={}):
         if code >= 400:
             if body != None:
                 self.send_error(code, body)
             else:
                 self.send_error(code)
-        else:
+        elif code == 304:
             self.send_response(code)
-            self.send_header("Cache-Control", "no-cache")
+            if not "Cache-Control" in headers:
+                self.send_header("Cache-Control", "no-cache")
+            for (name, value) in headers.items():
+                self.send_header(name, value)
+            self.send_header("Vary", NEGOTIATED_HEADERS)
+            self.end_headers()
+        else:
+            encodedBody = None
             if body != None:
-                encodedBody = body.encode();
+                if isinstance(body, bytes):
+                    encodedBody = body
+                else:
+                    encodedBody = body.encode()
+                # dynamic responses are validated by a hash of their body
+                if code == 200 and self.command == "GET" and not "ETag" in headers:
+                    headers = dict(headers)
+                    headers["ETag"] = 'W/"%08x"' % (zlib.crc32(encodedBody) & 0xffffffff)
+            if code == 200 and "ETag" in headers and matchETag(self.headers.get('If-None-Match'), headers["ETag"]):
+                return self.sendResponse(304, None, None, headers)
+
+            self.send_response(code)
+            if not "Cache-Control" in headers:
+                self.send_header("Cache-Control", "no-cache")
+            for (name, value) in headers.items():
+                self.send_header(name, value)
+            if encodedBody != None:
                 self.send_header("Content-Type", contentType);
+                if self.server.gzip and len(encodedBody) >= self.server.gzipMinSize and self.acceptsGzip():
+                    encodedBody = gzipCompress(encodedBody)
+                    self.send_header("Content-Encoding", "gzip")
+                self.send_header("Vary", NEGOTIATED_HEADERS)
                 self.send_header("Content-Length", len(encodedBody));
                 self.end_headers();
                 self.wfile.write(encodedBody)
+            else:
+                self.send_header("Content-Length", 0)
+                self.end_headers()
         self.logRequest(code)
 
+    def acceptsGzip(self):
+        if not self.server.gzip:
+            return False
+        encodings = self.headers.get('Accept-Encoding')
+        if encodings == None:
+            return False
+        for encoding in encodings.split(","):
+            params = encoding.strip().split(";")
+            if params[0].strip() == "gzip":
+                return not (len(params) > 1 and params[1].replace(" ", "") in ["q=0", "q=0.0", "q=0.00", "q=0.000"])
+        return False
+
+    def getAcceptedFormat(self):
+        # the serializer with the highest quality, None leaves JSON
+        accept = self.headers.get('Accept')
+        if accept == None:
+            return None
+        best = None
+        bestQuality = 0
+        for item in accept.split(","):
+            params = item.strip().split(";")
+            quality = 1.0
+            for param in params[1:]:
+                (name, sep, value) = param.strip().partition("=")
+                if name == "q":
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0
+            if params[0].strip() in SERIALIZERS and quality > bestQuality:
+                best = params[0].strip()
+                bestQuality = quality
+        return best
+
     def findFile(self, filepath):
         if os.path.exists(filepath):
             if os.path.isdir(filepath):
@@ -166,7 +596,7 @@ class HTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                 return filepath
         return None
 
-    def serveFile(self, relativePath):
+    def resolveFile(self, relativePath):
         if self.server.docroot != None:
             path = self.findFile(self.server.docroot + "/" + relativePath)
             if path == None:
@@ -181,31 +611,371 @@ class HTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             path = self.findFile(WEBIOPI_DOCROOT + "/" + relativePath)
 
         if path == None:
-            return self.sendResponse(404, "Not Found")
+            return (404, None)
 
         realPath = os.path.realpath(path)
 
         if realPath.endswith(".py"):
-            return self.sendResponse(403, "Not Authorized")
+            return (403, None)
 
         if not (realPath.startswith(os.getcwd())
                 or (self.server.docroot and realPath.startswith(self.server.docroot))
                 or realPath.startswith(WEBIOPI_DOCROOT)):
-            return self.sendResponse(403, "Not Authorized")
+            return (403, None)
+
+        return (200, path)
+
+    def findAsset(self, relativePath):
+        asset = self.server.assets.get(relativePath)
+        if asset != None:
+            if clock() - asset.checked < ASSET_CHECK_INTERVAL:
+                return (200, asset)
+            try:
+                if not asset.isModified(os.stat(asset.path)):
+                    asset.checked = clock()
+                    return (200, asset)
+            except OSError:
+                pass
+            self.server.assets.remove(relativePath)
+
+        (code, path) = self.resolveFile(relativePath)
+        if code != 200:
+            return (code, None)
 
-        (contentType, encoding) = mime.guess_type(path)
         f = codecs.open(path, 'rb')
-        data = f.read()
-        f.close()
-        self.send_response(200)
-        self.send_header("Content-Type", contentType);
-        self.send_header("Content-Length", os.path.getsize(realPath))
-        self.end_headers()
-        self.wfile.write(data)
-        self.logRequest(200)
+        try:
+            asset = HTTPAsset(path, os.fstat(f.fileno()))
+            if asset.size <= self.server.assetMaxSize:
+                asset.data = f.read()
+        finally:
+            f.close()
 
-    def processRequest(self):
+        if asset.data != None and self.server.gzip:
+            self.loadGzip(asset)
+
+        weight = 0
+        if asset.data != None:
+            weight += len(asset.data)
+        if asset.gzipData != None:
+            weight += len(asset.gzipData)
+        self.server.assets.set(relativePath, asset, weight)
+        return (200, asset)
+
+    def loadGzip(self, asset):
+        # use a precompressed sidecar file when it is up to date, else compress once
+        try:
+            stat = os.stat(asset.path + ".gz")
+            if stat.st_mtime >= asset.mtime and stat.st_size <= self.server.assetMaxSize:
+                f = codecs.open(asset.path + ".gz", 'rb')
+                asset.gzipData = f.read()
+                f.close()
+                return
+        except OSError:
+            pass
+
+        if asset.size >= self.server.gzipMinSize and isCompressible(asset.contentType):
+            data = gzipCompress(asset.data)
+            if len(data) < asset.size:
+                asset.gzipData = data
+
+    def isNotModified(self, asset):
+        etags = self.headers.get('If-None-Match')
+        if etags != None:
+            return matchETag(etags, asset.etag) or matchETag(etags, asset.gzipETag)
+
+        since = self.headers.get('If-Modified-Since')
+        if since != None:
+            date = parsedate_tz(since)
+            if date != None:
+                return int(asset.mtime) <= mktime_tz(date)
+        return False
+
+    def getRange(self, asset):
+        # returns None to send the whole file, False if the range cannot be satisfied
+        header = self.headers.get('Range')
+        if header == None or not header.startswith("bytes=") or "," in header:
+            return None
+
+        condition = self.headers.get('If-Range')
+        if condition != None and not condition.strip() in [asset.etag, asset.lastModified]:
+            return None
+
+        try:
+            (start, end) = header[6:].split("-", 1)
+            if len(start.strip()) == 0:
+                start = asset.size - int(end)
+                end = asset.size - 1
+                if start < 0:
+                    start = 0
+            else:
+                start = int(start)
+                if len(end.strip()) > 0:
+                    end = min(int(end), asset.size - 1)
+                else:
+                    end = asset.size - 1
+        except ValueError:
+            return None
+
+        if start > end or start >= asset.size:
+            return False
+        return (start, end)
+
+    def sendFile(self, f, offset, count):
+        if hasattr(self.request, "sendfile"):
+            self.wfile.flush()
+            self.request.sendfile(f, offset, count)
+        else:
+            f.seek(offset)
+            while count > 0:
+                data = f.read(min(count, 65536))
+                if not data:
+                    break
+                self.wfile.write(data)
+                count -= len(data)
+
+    def serveFile(self, relativePath):
+        (code, asset) = self.findAsset(relativePath)
+        if code == 404:
+            return self.sendResponse(404, "Not Found")
+        elif code == 403:
+            return self.sendResponse(403, "Not Authorized")
+
+        byteRange = self.getRange(asset)
+        etag = asset.etag
+        data = asset.data
+        gzipped = byteRange == None and asset.gzipData != None and self.acceptsGzip()
+        if gzipped:
+            etag = asset.gzipETag
+            data = asset.gzipData
+
+        if self.isNotModified(asset):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", asset.lastModified)
+            if asset.gzipData != None:
+                self.send_header("Vary", "Accept-Encoding")
+            self.end_headers()
+            return self.logRequest(304)
+
+        # files too big to be cached are sent straight from the page cache
+        f = None
+        if data == None:
+            f = codecs.open(asset.path, 'rb')
+            stat = os.fstat(f.fileno())
+            if asset.isModified(stat):
+                asset = HTTPAsset(asset.path, stat)
+                self.server.assets.set(relativePath, asset)
+                etag = asset.etag
+                byteRange = self.getRange(asset)
+
+        try:
+            if byteRange == False:
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%d" % asset.size)
+                self.send_header("Content-Length", 0)
+                self.end_headers()
+                return self.logRequest(416)
+
+            if byteRange != None:
+                code = 206
+                (start, end) = byteRange
+            else:
+                code = 200
+                (start, end) = (0, asset.size - 1)
+            if gzipped:
+                length = len(data)
+            else:
+                length = end - start + 1
+
+            self.send_response(code)
+            self.send_header("Content-Type", asset.contentType);
+            self.send_header("Content-Length", length)
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", asset.lastModified)
+            if code == 206:
+                self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, asset.size))
+            if asset.gzipData != None:
+                if gzipped:
+                    self.send_header("Content-Encoding", "gzip")
+                self.send_header("Vary", "Accept-Encoding")
+            self.end_headers()
+
+            if f != None:
+                self.sendFile(f, start, length)
+            elif gzipped:
+                self.wfile.write(data)
+            else:
+                self.wfile.write(data[start:end+1])
+        finally:
+            if f != None:
+                f.close()
+        self.logRequest(code)
+
+    def serveEvents(self, params):
+        monitor = self.server.handler.monitor
+        if monitor == None:
+            return self.sendResponse(404, "Not Found")
+        if not self.server.streaming:
+            return self.sendResponse(503, "Events Require HTTP Workers")
+
+        if not self.server.acquireStream():
+            self.close_connection = True
+            return self.sendResponse(503, "Too Many Streams")
+
+        paths = []
+        if "watch" in params and params["watch"]:
+            paths = [path.strip("/") for path in params["watch"].split(",")]
+
+        try:
+            self.close_connection = True
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            self.logRequest(200)
+            self.streamEvents(monitor, paths)
+        finally:
+            self.server.releaseStream()
+
+    def streamEvents(self, monitor, paths):
+        events = Queue.Queue()
+        subscription = monitor.subscribe(lambda event, data: events.put((event, data)), paths)
+        self.request.settimeout(self.server.timeout)
+        try:
+            while self.server.running:
+                try:
+                    (event, data) = events.get(timeout=EVENTS_PING_INTERVAL)
+                    self.wfile.write(formatEvent(event, data))
+                except Queue.Empty:
+                    self.wfile.write(b": ping\n\n")
+                self.wfile.flush()
+        except socket.error:
+            pass
+        finally:
+            monitor.unsubscribe(subscription)
+
+    def checkOrigin(self):
+        # browsers send the cookies and credentials of the device along with
+        # WebSockets opened by any site, only the device pages may use them
+        origin = self.headers.get("Origin")
+        if origin == None:
+            return True
+        origin = origin.strip().rstrip("/").lower()
+        if origin in self.server.origins or "*" in self.server.origins:
+            return True
+        host = self.headers.get("Host")
+        return host != None and urlparse(origin).netloc == host.strip().lower()
+
+    def getVersioned(self, relativePath, since, wait, compact):
+        # long-polling holds a worker, beyond the streams cap it is answered at once
         self.request.settimeout(None)
+        if wait <= 0 or not self.server.acquireStream():
+            return self.server.handler.getVersioned(relativePath, since, 0, compact)
+        try:
+            return self.server.handler.getVersioned(relativePath, since, wait, compact)
+        finally:
+            self.server.releaseStream()
+
+    def serveWebSocket(self):
+        key = self.headers.get('Sec-WebSocket-Key')
+        if key == None or self.headers.get('Sec-WebSocket-Version') != "13":
+            return self.sendResponse(400, "WebSocket Handshake Expected")
+        if not self.checkOrigin():
+            return self.sendResponse(403, "Origin Not Allowed")
+        if not self.server.streaming:
+            return self.sendResponse(503, "WebSocket Requires HTTP Workers")
+        if not self.server.acquireStream():
+            self.close_connection = True
+            return self.sendResponse(503, "Too Many Streams")
+
+        try:
+            # the usual Connection header would break the upgrade
+            self.close_connection = True
+            BaseHTTPServer.BaseHTTPRequestHandler.send_response(self, 101)
+            self.send_header("Upgrade", "websocket")
+            self.send_header("Connection", "Upgrade")
+            self.send_header("Sec-WebSocket-Accept", websocket.acceptKey(key))
+            if self.sessionToken != None:
+                self.send_header("Set-Cookie", "%s=%s; Path=/; HttpOnly" % (SESSION_COOKIE, self.sessionToken))
+            self.end_headers()
+            self.logRequest(101)
+            self.runWebSocket()
+        finally:
+            self.server.releaseStream()
+
+    def runWebSocket(self):
+        # frames are only written by this thread, with a timeout, so neither
+        # the monitor thread nor the reader ever wait for a slow client
+        frames = Queue.Queue(WEBSOCKET_QUEUE_SIZE)
+        def send(opcode, payload):
+            try:
+                frames.put_nowait(websocket.encodeFrame(opcode, payload))
+            except Queue.Full:
+                self.shutdownSocket()
+
+        def read(size):
+            data = self.rfile.read(size)
+            if len(data) < size:
+                raise EOFError()
+            return data
+
+        session = websocket.WebSocketSession(self.server.handler, lambda text: send(websocket.OP_TEXT, text.encode()))
+
+        def readFrames():
+            try:
+                while self.server.running:
+                    (fin, opcode, payload) = websocket.readFrame(read)
+                    if opcode == websocket.OP_PING:
+                        send(websocket.OP_PONG, payload)
+                        continue
+                    messages = session.processFrame(fin, opcode, payload)
+                    if messages == None:
+                        send(websocket.OP_CLOSE, payload[:2])
+                        break
+                    for message in messages:
+                        send(websocket.OP_TEXT, session.processMessage(message).encode())
+            except (socket.error, EOFError, ValueError):
+                pass
+            finally:
+                session.close()
+                try:
+                    frames.put_nowait(None)
+                except Queue.Full:
+                    self.shutdownSocket()
+
+        self.request.settimeout(None)
+        if hasattr(socket, "SO_SNDTIMEO"):
+            self.request.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, struct.pack("ll", self.server.timeout, 0))
+        self.wfile.flush()
+        reader = threading.Thread(target=readFrames, name="WebSocketReader")
+        reader.daemon = True
+        reader.start()
+        try:
+            while True:
+                try:
+                    frame = frames.get(timeout=EVENTS_PING_INTERVAL)
+                except Queue.Empty:
+                    if not reader.is_alive():
+                        break
+                    continue
+                if frame == None:
+                    break
+                self.wfile.write(frame)
+                self.wfile.flush()
+        except socket.error:
+            pass
+        finally:
+            self.shutdownSocket()
+            reader.join()
+
+    def shutdownSocket(self):
+        try:
+            self.request.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def processRequest(self):
         if not self.checkAuthentication():
             return self.requestAuthentication()
 
@@ -218,6 +988,7 @@ class HTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         if relativePath == "webiopi" or relativePath == "webiopi/":
             self.send_response(301)
             self.send_header("Location", "/")
+            self.send_header("Content-Length", 0)
             self.end_headers()
             return
 
@@ -234,23 +1005,47 @@ class HTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         if 'compact' in params:
             compact = str2bool(params['compact'])
 
+        if self.command == "GET" and relativePath == "events":
+            return self.serveEvents(params)
+        if self.command == "GET" and relativePath == "ws":
+            return self.serveWebSocket()
+
         try:
             result = (None, None, None)
-            if self.command == "GET":
-                result = self.server.handler.do_GET(relativePath, compact)
+            self.server.handler.setFormat(self.getAcceptedFormat())
+            if self.command == "GET" and params.get("since") != None:
+                wait = 0
+                if params.get("wait") != None:
+                    try:
+                        wait = float(params["wait"])
+                    except ValueError:
+                        wait = -1
+                    if math.isnan(wait) or math.isinf(wait) or wait < 0:
+                        return self.sendResponse(400, "Bad Wait")
+                    wait = min(wait, LONG_POLL_MAX_WAIT)
+                result = self.getVersioned(relativePath, params["since"], wait, compact)
+                if result == None:
+                    # answered once the value changed, see AsyncHTTPHandler
+                    return
+            elif self.command == "GET":
+                self.request.settimeout(None)
+                result = self.server.handler.do_GET(relativePath, compact, self.headers.get('If-None-Match'))
             elif self.command == "POST":
                 length = 0
                 length_header = 'content-length'
                 if length_header in self.headers:
                     length = int(self.headers[length_header])
-                result = self.server.handler.do_POST(relativePath, self.rfile.read(length), compact)
+                data = self.rfile.read(length)
+                self.unreadBody = False
+                self.request.settimeout(None)
+                result = self.server.handler.do_POST(relativePath, data, compact)
             else:
                 result = (405, None, None)
 
             (code, body, contentType) = result
 
             if code > 0:
-                self.sendResponse(code, body, contentType)
+                self.sendResponse(code, body, contentType, self.server.handler.getHeaders())
             else:
                 if self.command == "GET":
                     self.serveFile(relativePath)
@@ -261,6 +1056,11 @@ class HTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             self.sendResponse(403, "%s" % e)
         except ValueError as e:
             self.sendResponse(403, "%s" % e)
+        except socket.timeout as e:
+            # a body not received in time is answered with 408, see handleRequest
+            if self.reader == None or not self.reader.expired:
+                self.sendResponse(500)
+            raise e
         except Exception as e:
             self.sendResponse(500)
             raise e
@@ -0,0 +1,96 @@
+#   Copyright 2012-2013 Eric Ptak - trouch.com
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import binascii
+import os
+import threading
+
+from webiopi.utils import logger
+from webiopi.utils.cache import LRUCache, clock
+from webiopi.utils.thread import WorkerPool
+
+# finished jobs are kept for status requests until this many newer ones exist
+JOB_HISTORY = 64
+
+# calls waiting for a worker of an asynchronous macro
+JOB_QUEUE = 8
+
+class MacroJob():
+    def __init__(self, macro, args):
+        self.id = binascii.hexlify(os.urandom(8)).decode()
+        self.macro = macro
+        self.args = args
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.started = None
+
+    def run(self):
+        self.started = clock()
+        self.status = "running"
+        try:
+            result = self.macro(*self.args)
+            if not self.isExpired():
+                if result:
+                    self.result = "%s" % result
+                self.status = "done"
+        except Exception as e:
+            logger.exception(e)
+            if not self.isExpired():
+                self.error = "%s" % e
+                self.status = "error"
+        if self.isExpired():
+            self.status = "timeout"
+
+    def isExpired(self):
+        # Python threads cannot be killed, a macro running late only loses its result
+        return self.started != None and self.macro.timeout > 0 and clock() - self.started > self.macro.timeout
+
+    def getStatus(self):
+        status = {"id": self.id, "macro": self.macro.__name__, "status": self.status}
+        if self.status == "running" and self.isExpired():
+            status["status"] = "timeout"
+        if self.status == "done":
+            status["result"] = self.result
+        elif self.status == "error":
+            status["error"] = self.error
+        return status
+
+class JobManager():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pools = {}
+        self.jobs = LRUCache(JOB_HISTORY)
+
+    def submit(self, macro, args):
+        # returns None when all workers of the macro are busy and its queue is full
+        with self.lock:
+            name = macro.__name__
+            if not name in self.pools:
+                self.pools[name] = WorkerPool("Macro-%s" % name, macro.workers, JOB_QUEUE)
+            pool = self.pools[name]
+        job = MacroJob(macro, args)
+        self.jobs.set(job.id, job)
+        if not pool.submit(job.run):
+            self.jobs.remove(job.id)
+            return None
+        return job
+
+    def getJob(self, jid):
+        return self.jobs.get(jid)
+
+    def stop(self):
+        with self.lock:
+            for pool in self.pools.values():
+                pool.stop()
@@ -0,0 +1,267 @@
+#   Copyright 2012-2013 Eric Ptak - trouch.com
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import binascii
+import os
+import threading
+
+from webiopi.utils.logger import exception
+from webiopi.utils.cache import LRUCache, clock
+
+# path of the full GPIO state, as in GET /*
+STATE_PATH = "*"
+
+def diffState(old, new):
+    if old == None:
+        return new
+    changes = {}
+    for key in new:
+        if key == "GPIO":
+            gpios = {}
+            for gpio in new[key]:
+                if old.get(key, {}).get(gpio) != new[key][gpio]:
+                    gpios[gpio] = new[key][gpio]
+            if len(gpios) > 0:
+                changes[key] = gpios
+        elif old.get(key) != new[key]:
+            changes[key] = new[key]
+    return changes
+
+class TrackedValue():
+    # last value of a path with the version each of its channels changed at
+    def __init__(self):
+        self.value = None
+        self.version = 0
+        self.base = 0
+        self.versions = {}
+
+    def update(self, value, version):
+        # returns the changes, None if there is none
+        if isinstance(value, dict) and isinstance(self.value, dict):
+            changes = diffState(self.value, value)
+            if len(changes) == 0:
+                return None
+            for key in changes:
+                if key == "GPIO":
+                    for gpio in changes[key]:
+                        self.versions[(key, gpio)] = version
+                else:
+                    self.versions[(key,)] = version
+        elif self.version > 0 and value == self.value:
+            return None
+        else:
+            # nothing is known about channels before this version
+            changes = value
+            self.versions = {}
+            self.base = version
+        self.value = value
+        self.version = version
+        return changes
+
+    def getDelta(self, since):
+        if since < self.base or not isinstance(self.value, dict):
+            return self.value
+        delta = {}
+        for key in self.value:
+            if key == "GPIO":
+                gpios = {}
+                for gpio in self.value[key]:
+                    if self.versions.get((key, gpio), 0) > since:
+                        gpios[gpio] = self.value[key][gpio]
+                if len(gpios) > 0:
+                    delta[key] = gpios
+            elif self.versions.get((key,), 0) > since:
+                delta[key] = self.value[key]
+        return delta
+
+class StateMonitor(threading.Thread):
+    # samples GPIO and watched device values once for all subscribers and
+    # only publishes changes, the thread sleeps while nobody is interested
+    def __init__(self, handler, interval=1.0):
+        threading.Thread.__init__(self, name="MonitorThread")
+        self.daemon = True
+        self.handler = handler
+        self.interval = interval
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
+        self.sampling = threading.Lock()
+        self.wakeup = threading.Event()
+        self.subscribers = {}
+        self.waiters = {}
+        self.listeners = {}
+        self.lastId = 0
+        self.version = 0
+        # tells versions apart from the ones of a previous run
+        self.epoch = binascii.hexlify(os.urandom(4)).decode()
+        self.tracked = LRUCache(64)
+        self.running = True
+        self.start()
+
+    def subscribe(self, callback, paths=[]):
+        # callback(event, data) is called from the monitor thread and must not block
+        with self.lock:
+            self.lastId += 1
+            self.subscribers[self.lastId] = (callback, paths)
+            tracked = self.tracked.get((STATE_PATH, False))
+            if tracked != None:
+                callback("state", tracked.value)
+            for path in paths:
+                tracked = self.tracked.get((path, False))
+                if tracked != None:
+                    callback("device", {"path": path, "value": tracked.value})
+            subscription = self.lastId
+        self.wakeup.set()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            if subscription in self.subscribers:
+                del self.subscribers[subscription]
+
+    def notify(self):
+        self.wakeup.set()
+
+    def formatVersion(self, version):
+        return "%s.%d" % (self.epoch, version)
+
+    def parseVersion(self, token):
+        # "epoch.version" tokens from a previous run start over from version 0
+        (epoch, sep, version) = ("%s" % token).partition(".")
+        if epoch != self.epoch:
+            return 0
+        try:
+            return int(version)
+        except ValueError:
+            return 0
+
+    def getChanges(self, path, since, wait=0, compact=False):
+        # returns (version, changes since the given version) after waiting up to wait
+        # seconds for a change, or None when the path cannot be versioned
+        key = (path, compact)
+        with self.lock:
+            if since > self.version:
+                # version from a previous run, start over
+                since = 0
+            self.waiters[key] = self.waiters.get(key, 0) + 1
+        try:
+            self.sample([key])
+            self.wakeup.set()
+            deadline = clock() + wait
+            with self.lock:
+                while True:
+                    tracked = self.tracked.get(key)
+                    if tracked == None:
+                        return None
+                    remaining = deadline - clock()
+                    if tracked.version > since or remaining <= 0 or not self.running:
+                        return (tracked.version, tracked.getDelta(since))
+                    self.changed.wait(remaining)
+        finally:
+            with self.lock:
+                self.waiters[key] -= 1
+                if self.waiters[key] == 0:
+                    del self.waiters[key]
+
+    def addWaiter(self, path, since, callback, compact=False):
+        # callback() is called from the monitor thread, and must not block, once
+        # the path changed after since, it waits without holding a thread
+        key = (path, compact)
+        with self.lock:
+            if since > self.version:
+                since = 0
+            self.waiters[key] = self.waiters.get(key, 0) + 1
+            self.lastId += 1
+            self.listeners[self.lastId] = (key, since, callback)
+            waiter = self.lastId
+            tracked = self.tracked.get(key)
+            if tracked != None and tracked.version > since:
+                callback()
+        self.wakeup.set()
+        return waiter
+
+    def removeWaiter(self, waiter):
+        with self.lock:
+            if waiter in self.listeners:
+                (key, since, callback) = self.listeners.pop(waiter)
+                self.waiters[key] -= 1
+                if self.waiters[key] == 0:
+                    del self.waiters[key]
+
+    def getInterests(self):
+        keys = list(self.waiters.keys())
+        if len(self.subscribers) > 0 and not (STATE_PATH, False) in keys:
+            keys.append((STATE_PATH, False))
+        for (callback, watched) in self.subscribers.values():
+            for path in watched:
+                if not (path, False) in keys:
+                    keys.append((path, False))
+        return keys
+
+    def run(self):
+        while self.running:
+            with self.lock:
+                keys = self.getInterests()
+            if len(keys) == 0:
+                self.wakeup.wait()
+            else:
+                self.sample(keys)
+                self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+    def sample(self, keys):
+        with self.sampling:
+            for (path, compact) in keys:
+                try:
+                    value = self.handler.getValue(path, compact)
+                except Exception as e:
+                    exception(e)
+                    continue
+                if value != None:
+                    self.update(path, compact, value)
+
+    def update(self, path, compact, value):
+        # returns the version of the value
+        with self.lock:
+            tracked = self.tracked.get((path, compact))
+            if tracked == None:
+                tracked = TrackedValue()
+                self.tracked.set((path, compact), tracked)
+            changes = tracked.update(value, self.version + 1)
+            if changes == None:
+                return tracked.version
+            self.version += 1
+            self.changed.notify_all()
+            for (key, since, callback) in list(self.listeners.values()):
+                if key == (path, compact):
+                    try:
+                        callback()
+                    except Exception as e:
+                        exception(e)
+            if compact:
+                return tracked.version
+            for (callback, watched) in list(self.subscribers.values()):
+                try:
+                    if path == STATE_PATH:
+                        callback("state", changes)
+                    elif path in watched:
+                        callback("device", {"path": path, "value": value})
+                except Exception as e:
+                    exception(e)
+            return tracked.version
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+        with self.lock:
+            self.changed.notify_all()
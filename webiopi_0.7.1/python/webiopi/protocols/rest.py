@@ -12,9 +12,16 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import json
+import threading
+import itertools
+
 from webiopi.utils import types
 from webiopi.utils import logger
 from webiopi.utils.types import M_JSON, M_PLAIN
+from webiopi.utils.cache import LRUCache, clock
+from webiopi.utils.thread import SingleFlight
+from webiopi.protocols.jobs import JobManager
 from webiopi.utils.version import BOARD_REVISION, VERSION_STRING, MAPPING
 from webiopi.devices import manager
 from webiopi.devices import instance
@@ -27,12 +34,33 @@ except:
 
 MACROS = {}
 
+# read-only operations of a batch run at most in this many threads at once
+BATCH_THREADS = 8
+BATCH_METHODS = ["GET", "POST"]
+
+# sent with results that cannot change while the server runs, they may after
+# a restart with another config or board, so clients only keep them an hour
+CONSTANT_CACHE_CONTROL = "max-age=3600"
+
+# the version changes with upgrades, which restart the server
+VERSION_CACHE_CONTROL = "max-age=86400"
+
+MAPPING_JSON = ("%s" % MAPPING).replace("'", '"')
+REVISION_STRING = "%s" % BOARD_REVISION
+
 class RESTHandler():
     def __init__(self):
         self.device_mapping = True
         self.export = []
         self.routes = {}
+        self.routeLengths = []
+        self.routeCache = LRUCache(256)
         self.macros = {}
+        self.jobs = JobManager()
+        self.monitor = None
+        self.local = threading.local()
+        self.flights = SingleFlight()
+        self.generations = itertools.count(1)
         
 
     def addMacro(self, macro):
@@ -44,61 +72,29 @@ class RESTHandler():
         if destination[0] == "/":
             destination = destination[1:]
         self.routes[source] = destination
+        # sources are looked up by length, longest first
+        self.routeLengths = sorted(set(len(s) for s in self.routes), reverse=True)
+        self.routeCache.clear()
         logger.info("Added Route /%s => /%s" % (source, destination))
         
     def findRoute(self, path):
-        for source in self.routes:
-            if path.startswith(source):
-                route = path.replace(source, self.routes[source])
-                logger.info("Routing /%s => /%s" % (path, route))
-                return route
-        return path
+        route = self.routeCache.get(path)
+        if route == None:
+            route = path
+            for length in self.routeLengths:
+                source = path[:length]
+                if source in self.routes:
+                    route = self.routes[source] + path[length:]
+                    break
+            self.routeCache.set(path, route)
+        if route != path:
+            logger.info("Routing /%s => /%s" % (path, route))
+        return route
         
-    def extract(self, fmtArray, pathArray, args):
-        if len(fmtArray) != len(pathArray):
-            return False
-        if len(fmtArray) == 0:
-            return True
-        fmt = fmtArray[0]
-        path = pathArray[0]
-        if fmt == path:
-            return self.extract(fmtArray[1:], pathArray[1:], args)
-        if fmt.startswith("%"):
-            
-            fmt = fmt[1:]
-            t = 's'
-            if fmt[0] == '(':
-                if fmt[-1] == ')':
-                    name = fmt[1:-1]
-                elif fmt[-2] == ')':                                   
-                    name = fmt[1:-2]
-                    t = fmt[-1]
-                else:
-                    raise Exception("Missing closing brace")
-            else:
-                name = fmt
-            
-            if t == 's':
-                args[name] = path
-            elif t == 'b':
-                args[name] = types.str2bool(path)
-            elif t == 'd':
-                args[name] = types.toint(path)
-            elif t == 'x':
-                args[name] = int(path, 16)
-            elif t == 'f':
-                args[name] = float(path)
-            else:
-                raise Exception("Unknown format type : %s" % t)
-            
-            return self.extract(fmtArray[1:], pathArray[1:], args)
-            
-        return False
-
     def getDeviceRoute(self, method, path):
         pathArray = path.split("/")
         deviceName = pathArray[0]
-        device = instance.DEVICES[deviceName]
+        device = instance.DEVICES.get(deviceName)
         if device == None:
             return (None, deviceName + " Not Found")
         pathArray = pathArray[1:]
@@ -107,31 +103,102 @@ class RESTHandler():
         if functionName in funcs:
             return (funcs[functionName], {})
         
-        for fname in funcs:
-            func = funcs[fname]
-            funcPathArray = func.path.split("/")
-            args = {}
-            if self.extract(funcPathArray, pathArray, args):
-                return (func, args) 
+        (func, args) = device["routes"][method].find(functionName)
+        if func != None:
+            return (func, args)
         
         return (None, functionName + " Not Found")
     
+    def setHeader(self, name, value):
+        # extra response headers for the request being processed by this thread
+        if not hasattr(self.local, "headers"):
+            self.local.headers = {}
+        self.local.headers[name] = value
+
+    def getHeaders(self):
+        return getattr(self.local, "headers", {})
+
+    def setFormat(self, contentType):
+        # serializer asked by the client of the request processed by this thread
+        self.local.format = contentType
+
+    def getFormat(self):
+        return getattr(self.local, "format", None)
+
+    def getContentType(self):
+        contentType = self.getFormat()
+        if not contentType in types.SERIALIZERS:
+            contentType = M_JSON
+        return contentType
+
+    def encode(self, obj):
+        contentType = self.getContentType()
+        return (types.SERIALIZERS[contentType](obj), contentType)
+
     def callDeviceFunction(self, method, path, data=None):
         (func, args) = self.getDeviceRoute(method, path)
         if func == None:
             return (404, args, M_PLAIN)
 
+        if method == "POST":
+            device = instance.DEVICES[path.split("/")[0]]
+            try:
+                return self.formatResult(func, self.invokeDeviceFunction(func, args, data))
+            finally:
+                # reads that overlapped the POST must not be cached
+                device["generation"] = next(self.generations)
+                device["cache"].clear()
+
+        return self.formatResult(func, self.readDeviceFunction(path, func, args, data))
+
+    def readDeviceFunction(self, path, func, args, data=None):
+        deviceName = path.split("/")[0]
+        device = instance.DEVICES[deviceName]
+
+        if getattr(func, "immutable", False):
+            self.setHeader("Cache-Control", CONSTANT_CACHE_CONTROL)
+            result = device["values"].get(path)
+            if result == None:
+                result = self.invokeDeviceFunction(func, args, data)
+                device["values"].set(path, result)
+            return result
+
+        # results are cached before formatting to serve any serializer
+        ttl = getattr(func, "cacheTTL", device["cacheTTL"])
+        maxAge = getattr(func, "maxAge", 0)
+        if maxAge > 0:
+            self.setHeader("Cache-Control", "max-age=%d" % maxAge)
+            ttl = max(ttl, maxAge)
+        if ttl > 0:
+            entry = device["cache"].get(path)
+            if entry != None and clock() - entry[1] < ttl:
+                self.setHeader("Age", int(clock() - entry[1]))
+                return entry[0]
+
+        # identical reads running at the same time share a single bus access
+        generation = device["generation"]
+        key = (deviceName, generation, func.path, tuple(sorted(args.items())))
+        result = self.flights.call(key, self.invokeDeviceFunction, func, args, data)
+        if ttl > 0 and device["generation"] == generation:
+            device["cache"].set(path, (result, clock()))
+            if device["generation"] != generation:
+                device["cache"].remove(path)
+            self.setHeader("Age", 0)
+        return result
+
+    def invokeDeviceFunction(self, func, args, data=None):
         if func.data != None:
             args[func.data] = data
-        
-        result = func(**args)
+        return func(**args)
+
+    def formatResult(self, func, result):
         response = None
         contentType = None
         if result != None:
             if hasattr(func, "contentType"):
                 contentType = func.contentType
                 if contentType == M_JSON:
-                    response = types.jsonDumps(result)
+                    (response, contentType) = self.encode(result)
                 else:
                     response = func.format % result
             else:
@@ -139,34 +206,47 @@ class RESTHandler():
         
         return (200, response, contentType)
         
-    def do_GET(self, relativePath, compact=False):
+    def do_GET(self, relativePath, compact=False, etags=None):
+        self.local.headers = {}
         relativePath = self.findRoute(relativePath)
         
         # JSON full state
         if relativePath == "*":
-            return (200, self.getJSON(compact), M_JSON)
+            state = self.getState(compact)
+            if self.monitor != None:
+                # the state version validates the response before it is encoded
+                version = self.monitor.update(relativePath, compact, state)
+                etag = 'W/"%s.%d-%s"' % (self.monitor.epoch, version, self.getContentType().split("/")[1])
+                self.setHeader("ETag", etag)
+                if types.matchETag(etags, etag):
+                    return (304, None, None)
+            (body, contentType) = self.encode(state)
+            return (200, body, contentType)
             
         # RPi header map
         elif relativePath == "map":
-            json = "%s" % MAPPING
-            json = json.replace("'", '"')
-            return (200, json, M_JSON)
+            self.setHeader("Cache-Control", CONSTANT_CACHE_CONTROL)
+            return (200, MAPPING_JSON, M_JSON)
 
         # server version
         elif relativePath == "version":
+            self.setHeader("Cache-Control", VERSION_CACHE_CONTROL)
             return (200, VERSION_STRING, M_PLAIN)
 
         # board revision
         elif relativePath == "revision":
-            revision = "%s" % BOARD_REVISION
-            return (200, revision, M_PLAIN)
+            self.setHeader("Cache-Control", CONSTANT_CACHE_CONTROL)
+            return (200, REVISION_STRING, M_PLAIN)
 
         # Single GPIO getter
         elif relativePath.startswith("GPIO/"):
             return self.callDeviceFunction("GET", relativePath)
         
         elif relativePath == "devices/*":
-            return (200, manager.getDevicesJSON(compact), M_JSON)
+            return self.getListing("devices", manager.getDevices, etags)
+
+        elif relativePath == "devices/*/routes":
+            return self.getListing("routes", manager.getRoutes, etags)
         
         elif relativePath.startswith("devices/"):
             if not self.device_mapping:
@@ -174,14 +254,33 @@ class RESTHandler():
             path = relativePath.replace("devices/", "")
             return self.callDeviceFunction("GET", path)
 
+        # asynchronous macro job status
+        elif relativePath.startswith("macros/jobs/"):
+            job = self.jobs.getJob(relativePath[len("macros/jobs/"):])
+            if job == None:
+                return (404, "Job Not Found", M_PLAIN)
+            return (200, types.jsonDumps(job.getStatus()), M_JSON)
+
         else:
             return (0, None, None)
 
     def do_POST(self, relativePath, data, compact=False):
+        result = self.processPOST(relativePath, data, compact)
+        if self.monitor != None and result[0] == 200:
+            self.monitor.notify()
+        return result
+
+    def processPOST(self, relativePath, data, compact=False):
+        self.local.headers = {}
         relativePath = self.findRoute(relativePath)
 
         if relativePath.startswith("GPIO/"):
             return self.callDeviceFunction("POST", relativePath)
+
+        elif relativePath == "batch":
+            result = self.executeBatch(data, compact)
+            self.local.headers = {}
+            return result
                 
         elif relativePath.startswith("macros/"):
             paths = relativePath.split("/")
@@ -196,12 +295,18 @@ class RESTHandler():
 
                 if ',' in value:
                     args = value.split(',')
-                    result = macro(*args)
                 elif len(value) > 0:
-                    result = macro(value)
+                    args = [value]
                 else:
-                    result = macro()
-                     
+                    args = []
+
+                if getattr(macro, "asynchronous", False):
+                    job = self.jobs.submit(macro, args)
+                    if job == None:
+                        return (503, mname + " Busy", M_PLAIN)
+                    return (202, types.jsonDumps(job.getStatus()), M_JSON)
+
+                result = macro(*args)
                 response = ""
                 if result:
                     response = "%s" % result
@@ -219,7 +324,145 @@ class RESTHandler():
         else: # path unknowns
             return (0, None, None)
 
-    def getJSON(self, compact=False):
+    def getValue(self, relativePath, compact=False):
+        # unformatted result of a GET, None if the path is not a device function
+        relativePath = self.findRoute(relativePath)
+        if relativePath == "*":
+            return self.getState(compact)
+        elif relativePath.startswith("GPIO/"):
+            path = relativePath
+        elif relativePath.startswith("devices/") and self.device_mapping:
+            path = relativePath.replace("devices/", "")
+        else:
+            return None
+        (func, args) = self.getDeviceRoute("GET", path)
+        if func == None:
+            return None
+        return self.readDeviceFunction(path, func, args)
+
+    def getVersioned(self, relativePath, since, wait=0, compact=False):
+        # changes since a version returned in X-State-Version, or the whole value
+        changes = None
+        if self.monitor != None:
+            changes = self.monitor.getChanges(relativePath, self.monitor.parseVersion(since), wait, compact)
+        if changes == None:
+            return self.do_GET(relativePath, compact)
+        self.local.headers = {"X-State-Version": self.monitor.formatVersion(changes[0])}
+        (body, contentType) = self.encode(changes[1])
+        return (200, body, contentType)
+
+    def getListing(self, name, build, etags=None):
+        # listings are encoded once per serializer until devices change, their
+        # version validates the response before it is encoded
+        contentType = self.getContentType()
+        etag = 'W/"%s.%s-%s"' % (name, manager.getListingsVersion(), contentType.split("/")[1])
+        self.setHeader("ETag", etag)
+        if types.matchETag(etags, etag):
+            return (304, None, None)
+        body = manager.getListing((name, contentType), lambda: types.SERIALIZERS[contentType](build()))
+        return (200, body, contentType)
+
+    def execute(self, method, relativePath, data=None, compact=False):
+        # runs a request outside of HTTP, errors are returned as HTTP codes
+        try:
+            if method == "GET":
+                result = self.do_GET(relativePath, compact)
+            elif method == "POST":
+                result = self.do_POST(relativePath, data, compact)
+            else:
+                return (405, "Method Not Allowed", M_PLAIN)
+        except (GPIO.InvalidDirectionException, GPIO.InvalidChannelException, GPIO.SetupException) as e:
+            return (403, "%s" % e, M_PLAIN)
+        except ValueError as e:
+            return (403, "%s" % e, M_PLAIN)
+        except Exception as e:
+            logger.exception(e)
+            return (500, "%s" % e, M_PLAIN)
+
+        if result[0] == 0:
+            return (404, "Not Found", M_PLAIN)
+        return result
+
+    def executeBatch(self, data, compact=False):
+        # [{"method", "path", "body"}, ...] or {"operations": [...], "stopOnError": true, "parallel": true}
+        try:
+            if not isinstance(data, str):
+                data = data.decode("UTF-8")
+            batch = json.loads(data)
+            if isinstance(batch, list):
+                batch = {"operations": batch}
+            operations = batch["operations"]
+            for operation in operations:
+                method = operation.get("method", "GET")
+                if not hasattr(method, "upper") or not method.upper() in BATCH_METHODS:
+                    raise ValueError("Bad method %s" % method)
+                if operation.get("path", "").strip("/") == "batch":
+                    raise ValueError("Nested batch")
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            return (400, "Bad Batch : %s" % e, M_PLAIN)
+
+        # operations are encoded in JSON, only the whole batch follows Accept
+        contentType = self.getFormat()
+        self.setFormat(None)
+        try:
+            results = self.runBatch(operations, batch.get("stopOnError", False), batch.get("parallel", False), compact)
+        finally:
+            self.setFormat(contentType)
+        (body, contentType) = self.encode(results)
+        return (200, body, contentType)
+
+    def runBatch(self, operations, stopOnError, parallel, compact):
+        results = []
+        i = 0
+        while i < len(operations):
+            # consecutive GETs can run together as they don't change anything
+            count = 1
+            if parallel:
+                while i + count < len(operations) and count < BATCH_THREADS and self.isReadOnly(operations[i]) and self.isReadOnly(operations[i + count]):
+                    count += 1
+            if count > 1:
+                group = [None] * count
+                threads = [threading.Thread(target=self.executeOperationAt, args=(operations[i + j], compact, group, j)) for j in range(count)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            else:
+                group = [self.executeOperation(operations[i], compact)]
+
+            for result in group:
+                results.append(result)
+                if stopOnError and result["code"] >= 400:
+                    return results
+            i += count
+
+        return results
+
+    def isReadOnly(self, operation):
+        return operation.get("method", "GET").upper() == "GET"
+
+    def executeOperation(self, operation, compact=False):
+        # operation is a decoded JSON object, the result is ready to be encoded back
+        data = operation.get("body")
+        if data != None:
+            if isinstance(data, (dict, list)):
+                data = json.dumps(data)
+            else:
+                data = "%s" % data
+            data = data.encode()
+        method = ("%s" % operation.get("method", "GET")).upper()
+        path = ("%s" % operation.get("path", "")).strip("/")
+        (code, body, contentType) = self.execute(method, path, data, operation.get("compact", compact))
+        result = {"code": code}
+        if body != None:
+            result["body"] = body
+            result["type"] = contentType
+        return result
+
+    def executeOperationAt(self, operation, compact, results, index):
+        results[index] = self.executeOperation(operation, compact)
+
+    def getState(self, compact=False):
         if compact:
             f = 'f'
             v = 'v'
@@ -227,9 +470,9 @@ class RESTHandler():
             f = 'function'
             v = 'value'
         
-        json = {}
+        state = {}
         for (bus, value) in BUSLIST.items():
-            json[bus] = int(value["enabled"])
+            state[bus] = int(value["enabled"])
         
         gpios = {}
         if len(self.export) > 0:
@@ -249,6 +492,8 @@ class RESTHandler():
                 (pwmType, value) = GPIO.getPulse(gpio).split(':')
                 gpios[gpio][pwmType] = value
         
-        json['GPIO'] = gpios
-        return types.jsonDumps(json)
+        state['GPIO'] = gpios
+        return state
 
+    def getJSON(self, compact=False):
+        return types.jsonDumps(self.getState(compact))
@@ -0,0 +1,150 @@
+#   Copyright 2012-2013 Eric Ptak - trouch.com
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# WebSocket (RFC 6455) frames carrying JSON messages :
+#   {"id": 1, "method": "POST", "path": "GPIO/17/value/1"}
+#       => {"id": 1, "code": 200, "body": "1", "type": "text/plain"}
+#   {"id": 2, "method": "SUBSCRIBE", "watch": ["devices/temp0/sensor/temperature/c"]}
+#       => {"id": 2, "code": 200} then {"event": "state", "data": {...}}
+
+import json
+import struct
+import base64
+import hashlib
+
+from webiopi.utils.types import jsonDumps
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+WEBSOCKET_MAX_SIZE = 65536
+
+OP_CONTINUATION = 0x0
+OP_TEXT         = 0x1
+OP_BINARY       = 0x2
+OP_CLOSE        = 0x8
+OP_PING         = 0x9
+OP_PONG         = 0xA
+
+def acceptKey(key):
+    digest = hashlib.sha1((key.strip() + WEBSOCKET_GUID).encode()).digest()
+    return base64.b64encode(digest).decode()
+
+def encodeFrame(opcode, payload=b""):
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode, length)
+    elif length < 65536:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+    return header + payload
+
+def parseHeader(data):
+    (first, second) = struct.unpack("!BB", data)
+    return (first & 0x80 != 0, first & 0x0F, second & 0x80 != 0, second & 0x7F)
+
+def unmask(mask, payload):
+    mask = bytearray(mask)
+    payload = bytearray(payload)
+    for i in range(len(payload)):
+        payload[i] ^= mask[i % 4]
+    return bytes(payload)
+
+def readFrame(read):
+    # read(size) must return exactly size bytes
+    (fin, opcode, masked, length) = parseHeader(read(2))
+    if length == 126:
+        length = struct.unpack("!H", read(2))[0]
+    elif length == 127:
+        length = struct.unpack("!Q", read(8))[0]
+    if length > WEBSOCKET_MAX_SIZE:
+        raise ValueError("WebSocket frame too big")
+    mask = None
+    if masked:
+        mask = read(4)
+    payload = read(length)
+    if mask != None:
+        payload = unmask(mask, payload)
+    return (fin, opcode, payload)
+
+class WebSocketSession():
+    def __init__(self, handler, send):
+        # send(text) writes a text frame and may be called from the monitor thread
+        self.handler = handler
+        self.send = send
+        self.subscription = None
+        self.fragments = None
+
+    def processFrame(self, fin, opcode, payload):
+        # returns the text messages completed by this frame, None on close
+        if opcode == OP_CLOSE:
+            return None
+        if opcode in [OP_TEXT, OP_BINARY]:
+            self.fragments = []
+        if opcode in [OP_TEXT, OP_BINARY, OP_CONTINUATION] and self.fragments != None:
+            self.fragments.append(payload)
+            if sum(len(fragment) for fragment in self.fragments) > WEBSOCKET_MAX_SIZE:
+                raise ValueError("WebSocket message too big")
+            if fin:
+                message = b"".join(self.fragments)
+                self.fragments = None
+                return [message.decode("UTF-8")]
+        return []
+
+    def processMessage(self, text):
+        # the thread may have served an HTTP request asking another serializer
+        self.handler.setFormat(None)
+        try:
+            message = json.loads(text)
+            if not isinstance(message, dict):
+                raise ValueError("JSON object expected")
+        except ValueError as e:
+            return self.reply(None, 400, "%s" % e)
+
+        mid = message.get("id")
+        method = str(message.get("method", "GET")).upper()
+        if method == "SUBSCRIBE":
+            if self.handler.monitor == None:
+                return self.reply(mid, 404, "Events Not Available")
+            paths = [str(path).strip("/") for path in message.get("watch", [])]
+            self.unsubscribe()
+            self.subscription = self.handler.monitor.subscribe(self.publish, paths)
+            return self.reply(mid, 200)
+        elif method == "UNSUBSCRIBE":
+            self.unsubscribe()
+            return self.reply(mid, 200)
+
+        result = self.handler.executeOperation(message)
+        result["id"] = mid
+        return jsonDumps(result)
+
+    def reply(self, mid, code, body=None, contentType=None):
+        message = {"id": mid, "code": code}
+        if body != None:
+            message["body"] = body
+            message["type"] = contentType
+        return jsonDumps(message)
+
+    def publish(self, event, data):
+        try:
+            self.send(jsonDumps({"event": event, "data": data}))
+        except Exception:
+            self.unsubscribe()
+
+    def unsubscribe(self):
+        if self.subscription != None:
+            self.handler.monitor.unsubscribe(self.subscription)
+            self.subscription = None
+
+    def close(self):
+        self.unsubscribe()
@@ -13,6 +13,7 @@
 #   limitations under the License.
 
 import os
+import sys
 import time
 import socket
 
@@ -20,10 +21,12 @@ from webiopi.utils.config import Config
 from webiopi.utils import loader
 from webiopi.utils import logger
 from webiopi.utils import crypto
+from webiopi.utils import types
 from webiopi.devices import manager
 from webiopi.protocols import rest
 from webiopi.protocols import http
 from webiopi.protocols import coap
+from webiopi.protocols.monitor import StateMonitor
 from webiopi.devices.digital.gpio import NativeGPIO
 
 def getLocalIP():
@@ -58,12 +61,16 @@ class Server():
             values = params.split(" ")
             driver = values[0];
             args = {}
+            cacheTTL = 0
             i = 1
             while i < len(values):
                 (arg, val) = values[i].split(":")
-                args[arg] = val
+                if arg == "cache":
+                    cacheTTL = types.parseDuration(val)
+                else:
+                    args[arg] = val
                 i+=1
-            manager.addDevice(name, driver, args)
+            manager.addDevice(name, driver, args, cacheTTL)
         
 
         if scriptfile != None:
@@ -81,6 +88,8 @@ class Server():
         if exports != None:
             self.gpio.export = [int(s) for s in exports.split(",")]
         self.restHandler.export = self.gpio.export
+        if config.getboolean("REST", "events", True):
+            self.restHandler.monitor = StateMonitor(self.restHandler, config.getfloat("REST", "events-interval", 1.0))
         
         http_port = config.getint("HTTP", "port", port)
         http_enabled = config.getboolean("HTTP", "enabled", http_port > 0)
@@ -88,10 +97,38 @@ class Server():
         context = config.get("HTTP", "context", None)
         docroot = config.get("HTTP", "doc-root", None)
         index = config.get("HTTP", "welcome-file", None)
+        http_workers = config.getint("HTTP", "workers", 0)
+        http_queue = config.getint("HTTP", "queue", 16)
+        http_streams = config.getint("HTTP", "streams", -1)
+        http_options = {
+            "timeout": config.getint("HTTP", "timeout", 10),
+            "keepAlive": config.getboolean("HTTP", "keep-alive", True),
+            "keepAliveTimeout": config.getint("HTTP", "keep-alive-timeout", 5),
+            "keepAliveRequests": config.getint("HTTP", "keep-alive-requests", 100),
+            "cacheSize": config.getint("HTTP", "cache-size", 2048),
+            "gzip": config.getboolean("HTTP", "gzip", True),
+            "gzipMinSize": config.getint("HTTP", "gzip-min-size", 1024),
+            "authCacheTTL": config.getint("HTTP", "auth-cache", 300),
+            "sessionTTL": config.getint("HTTP", "session", 0),
+            "origins": [origin.strip() for origin in config.get("HTTP", "websocket-origins", "").split(",") if origin.strip()]
+        }
             
         coap_port = config.getint("COAP", "port", coap_port)
         coap_enabled = config.getboolean("COAP", "enabled", coap_port > 0)
         coap_multicast = config.getboolean("COAP", "multicast", coap_enabled)
+        coap_workers = config.getint("COAP", "workers", 4)
+        coap_queue = config.getint("COAP", "queue", 16)
+        coap_options = {
+            "observeMaxAge": config.getint("COAP", "observe-max-age", coap.OBSERVE_MAX_AGE),
+            "blockSize": config.getint("COAP", "block-size", coap.COAP_BLOCK_SIZE),
+            "ackDelay": config.getfloat("COAP", "ack-delay", coap.COAP_ACK_DELAY)
+        }
+
+        engine = config.get("SERVER", "engine", "threads")
+        workers = config.getint("SERVER", "workers", 4)
+        if engine == "asyncio" and sys.version_info < (3, 7):
+            logger.warn("asyncio engine requires Python 3.7, using threads")
+            engine = "threads"
 
         routes = config.items("ROUTES")
         for (source, destination) in routes:
@@ -99,6 +136,7 @@ class Server():
     
         auth = None
         if http_passwdfile != None:
+            http_options["passwdFile"] = http_passwdfile
             if os.path.exists(http_passwdfile):
                 f = open(http_passwdfile)
                 auth = f.read().strip(" \r\n")
@@ -119,17 +157,30 @@ class Server():
         
         realm = config.get("HTTP", "prompt", None)
         
-        if http_enabled:
-            self.http_server = http.HTTPServer(self.host, http_port, self.restHandler, context, docroot, index, auth, realm)
-        else:
-            self.http_server = None
-        
-        if coap_enabled:
-            self.coap_server = coap.COAPServer(self.host, coap_port, self.restHandler)
-            if coap_multicast:
-                self.coap_server.enableMulticast()
+        self.http_server = None
+        self.coap_server = None
+        self.async_server = None
+
+        if engine == "asyncio":
+            from webiopi.protocols import aio
+            http_context = None
+            if http_enabled:
+                http_context = http.HTTPContext(self.host, http_port, self.restHandler, context, docroot, index, auth, realm, **http_options)
+            if not coap_enabled:
+                coap_port = 0
+            self.async_server = aio.AsyncServer(self.host, http_context, coap_port, self.restHandler, workers, coap_options)
+            if coap_enabled and coap_multicast:
+                self.async_server.enableMulticast()
+
         else:
-            self.coap_server = None
+            if http_enabled:
+                self.http_server = http.HTTPServer(self.host, http_port, self.restHandler, context, docroot, index, auth, realm,
+                                                   http_workers, http_queue, maxStreams=http_streams, **http_options)
+
+            if coap_enabled:
+                self.coap_server = coap.COAPServer(self.host, coap_port, self.restHandler, coap_workers, coap_queue, **coap_options)
+                if coap_multicast:
+                    self.coap_server.enableMulticast()
     
     def addMacro(self, macro):
         self.restHandler.addMacro(macro)
@@ -139,6 +190,11 @@ class Server():
             self.http_server.stop()
         if self.coap_server:
             self.coap_server.stop()
+        if self.async_server:
+            self.async_server.stop()
+        if self.restHandler.monitor:
+            self.restHandler.monitor.stop()
+        self.restHandler.jobs.stop()
         loader.unloadScripts()
         manager.closeDevices()
 
@@ -0,0 +1,57 @@
+import time
+import threading
+from collections import OrderedDict
+
+try:
+    clock = time.monotonic
+except AttributeError:
+    clock = time.time
+
+class LRUCache():
+    def __init__(self, maxSize=128, ttl=0, maxWeight=0):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.maxWeight = maxWeight
+        self.weight = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if not key in self.entries:
+                return default
+            (value, weight, expires) = self.entries.pop(key)
+            if expires > 0 and expires < clock():
+                self.weight -= weight
+                return default
+            self.entries[key] = (value, weight, expires)
+            return value
+
+    def set(self, key, value, weight=0):
+        if self.maxWeight > 0 and weight > self.maxWeight:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.weight -= self.entries.pop(key)[1]
+            if self.ttl > 0:
+                expires = clock() + self.ttl
+            else:
+                expires = 0
+            self.entries[key] = (value, weight, expires)
+            self.weight += weight
+            while len(self.entries) > self.maxSize or (self.maxWeight > 0 and self.weight > self.maxWeight):
+                (oldKey, (oldValue, oldWeight, oldExpires)) = self.entries.popitem(last=False)
+                self.weight -= oldWeight
+
+    def remove(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.weight -= self.entries.pop(key)[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.weight = 0
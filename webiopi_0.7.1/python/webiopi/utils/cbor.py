@@ -0,0 +1,62 @@
+import struct
+from webiopi.utils.version import PYTHON_MAJOR
+
+# minimal CBOR (RFC 7049) encoder for the values REST functions return
+
+if PYTHON_MAJOR >= 3:
+    TEXT_TYPES = (str,)
+    INTEGER_TYPES = (int,)
+else:
+    TEXT_TYPES = (str, unicode)
+    INTEGER_TYPES = (int, long)
+
+def encodeHead(major, value):
+    major <<= 5
+    if value < 24:
+        return struct.pack("!B", major | value)
+    elif value < 0x100:
+        return struct.pack("!BB", major | 24, value)
+    elif value < 0x10000:
+        return struct.pack("!BH", major | 25, value)
+    elif value < 0x100000000:
+        return struct.pack("!BI", major | 26, value)
+    return struct.pack("!BQ", major | 27, value)
+
+def encode(obj, out):
+    if obj is None:
+        out.append(b"\xf6")
+    elif obj is True:
+        out.append(b"\xf5")
+    elif obj is False:
+        out.append(b"\xf4")
+    elif isinstance(obj, INTEGER_TYPES):
+        if obj >= 0:
+            out.append(encodeHead(0, obj))
+        else:
+            out.append(encodeHead(1, -1 - obj))
+    elif isinstance(obj, float):
+        out.append(struct.pack("!Bd", 0xfb, obj))
+    elif isinstance(obj, TEXT_TYPES):
+        # a Python 2 str already holds UTF-8 bytes
+        data = obj if isinstance(obj, bytes) else obj.encode("UTF-8")
+        out.append(encodeHead(3, len(data)))
+        out.append(data)
+    elif isinstance(obj, (bytes, bytearray)):
+        out.append(encodeHead(2, len(obj)))
+        out.append(bytes(obj))
+    elif isinstance(obj, (list, tuple)):
+        out.append(encodeHead(4, len(obj)))
+        for item in obj:
+            encode(item, out)
+    elif isinstance(obj, dict):
+        out.append(encodeHead(5, len(obj)))
+        for (key, value) in obj.items():
+            encode(key, out)
+            encode(value, out)
+    else:
+        encode("%s" % obj, out)
+
+def dumps(obj):
+    out = []
+    encode(obj, out)
+    return b"".join(out)
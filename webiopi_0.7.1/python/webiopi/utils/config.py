@@ -28,6 +28,11 @@ class Config():
         if self.config.has_option(section, key):
             return self.config.getint(section, key)
         return default
+
+    def getfloat(self, section, key, default):
+        if self.config.has_option(section, key):
+            return self.config.getfloat(section, key)
+        return default
     
     def items(self, section):
         if self.config.has_section(section):
@@ -0,0 +1,88 @@
+from webiopi.utils import types
+
+def parseFormat(fmt):
+    # "%(name)d" => ("name", converter), as in the paths of @request
+    fmt = fmt[1:]
+    t = 's'
+    if fmt[0] == '(':
+        if fmt[-1] == ')':
+            name = fmt[1:-1]
+        elif fmt[-2] == ')':
+            name = fmt[1:-2]
+            t = fmt[-1]
+        else:
+            raise Exception("Missing closing brace")
+    else:
+        name = fmt
+
+    if t == 's':
+        return (name, lambda value: value)
+    elif t == 'b':
+        return (name, types.str2bool)
+    elif t == 'd':
+        return (name, types.toint)
+    elif t == 'x':
+        return (name, lambda value: int(value, 16))
+    elif t == 'f':
+        return (name, float)
+    raise Exception("Unknown format type : %s" % t)
+
+class RouteNode():
+    def __init__(self):
+        self.func = None
+        self.children = {}
+        self.params = []
+
+class RouteTrie():
+    # routes are split in segments once, literal segments are matched before formatted ones
+    def __init__(self):
+        self.root = RouteNode()
+
+    def add(self, path, func):
+        node = self.root
+        for segment in path.split("/"):
+            if segment.startswith("%"):
+                (name, convert) = parseFormat(segment)
+                child = None
+                for (paramName, paramConvert, paramNode, paramFormat) in node.params:
+                    if paramFormat == segment:
+                        child = paramNode
+                if child == None:
+                    child = RouteNode()
+                    node.params.append((name, convert, child, segment))
+                node = child
+            else:
+                if not segment in node.children:
+                    node.children[segment] = RouteNode()
+                node = node.children[segment]
+        if node.func == None:
+            node.func = func
+
+    def find(self, path):
+        # returns (func, args), or raises the first conversion error when nothing matches
+        args = {}
+        errors = []
+        func = self.match(self.root, path.split("/"), 0, args, errors)
+        if func == None and len(errors) > 0:
+            raise errors[0]
+        return (func, args)
+
+    def match(self, node, segments, index, args, errors):
+        if index == len(segments):
+            return node.func
+        segment = segments[index]
+        if segment in node.children:
+            func = self.match(node.children[segment], segments, index + 1, args, errors)
+            if func != None:
+                return func
+        for (name, convert, child, fmt) in node.params:
+            try:
+                value = convert(segment)
+            except ValueError as e:
+                errors.append(e)
+                continue
+            func = self.match(child, segments, index + 1, args, errors)
+            if func != None:
+                args[name] = value
+                return func
+        return None
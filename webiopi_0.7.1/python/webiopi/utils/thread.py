@@ -2,6 +2,12 @@ import time
 import signal
 import threading
 from webiopi.utils import logger
+from webiopi.utils.version import PYTHON_MAJOR
+
+if PYTHON_MAJOR >= 3:
+    import queue as Queue
+else:
+    import Queue
 
 RUNNING = False
 TASKS = []
@@ -24,6 +30,93 @@ class Task(threading.Thread):
         else:
             self.func()
 
+class WorkerPool():
+    def __init__(self, name, workers, queueSize=0):
+        self.name = name
+        self.queueSize = queueSize
+        self.queue = Queue.Queue()
+        # pending tasks, including those being run, are bounded by workers + queueSize
+        self.slots = threading.Semaphore(workers + queueSize)
+        self.running = True
+        self.busy = 0
+        self.busyLock = threading.Lock()
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.work, name="%s-%d" % (name, i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, func, *args):
+        # returns False instead of blocking when the queue is full
+        if not self.running or not self.slots.acquire(False):
+            return False
+        self.queue.put((func, args))
+        return True
+
+    def work(self):
+        while self.running:
+            try:
+                (func, args) = self.queue.get(timeout=1)
+            except Queue.Empty:
+                continue
+            with self.busyLock:
+                self.busy += 1
+            try:
+                func(*args)
+            except Exception as e:
+                logger.exception(e)
+            finally:
+                with self.busyLock:
+                    self.busy -= 1
+                self.slots.release()
+
+    def isSaturated(self):
+        # tasks are waiting in the queue, or would be rejected without a queue
+        if self.queueSize > 0:
+            return not self.queue.empty()
+        return self.busy >= len(self.threads)
+
+    def stop(self):
+        self.running = False
+
+class FlightCall():
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight():
+    # concurrent calls sharing a key wait for the first one instead of running again
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def call(self, key, func, *args):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call == None
+            if leader:
+                call = FlightCall()
+                self.calls[key] = call
+
+        if not leader:
+            call.done.wait()
+            if call.error != None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
 def stop(signum=0, frame=None):
     global RUNNING
     if RUNNING:
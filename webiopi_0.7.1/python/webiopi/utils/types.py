@@ -1,8 +1,11 @@
 import json
 from webiopi.utils import logger
+from webiopi.utils import cbor
 
-M_PLAIN = "text/plain"
-M_JSON  = "application/json"
+M_PLAIN   = "text/plain"
+M_JSON    = "application/json"
+M_CBOR    = "application/cbor"
+M_MSGPACK = "application/msgpack"
 
 def jsonDumps(obj):
     if logger.debugEnabled():
@@ -10,9 +13,43 @@ def jsonDumps(obj):
     else:
         return json.dumps(obj)
     
+# structured responses can be encoded with any of these, selected by Accept
+SERIALIZERS = {M_JSON: jsonDumps, M_CBOR: cbor.dumps}
+
+try:
+    import msgpack
+    SERIALIZERS[M_MSGPACK] = lambda obj: msgpack.packb(obj, use_bin_type=True)
+except ImportError:
+    pass
+
+def matchETag(header, etag):
+    # weak comparison of an If-None-Match header with an entity tag
+    if header == None or etag == None:
+        return False
+    if etag.startswith("W/"):
+        etag = etag[2:]
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == "*" or candidate == etag:
+            return True
+    return False
+
 def str2bool(value):
     return (value == "1") or (value == "true") or (value == "True") or (value == "yes") or (value == "Yes")
 
+def parseDuration(value):
+    # "500ms", "2s" or a number of seconds
+    if isinstance(value, (int, float)):
+        return value
+    value = value.strip()
+    if value.endswith("ms"):
+        return float(value[:-2]) / 1000
+    if value.endswith("s"):
+        return float(value[:-1])
+    return float(value)
+
 def toint(value):
     if isinstance(value, str):
         if value.startswith("0b"):